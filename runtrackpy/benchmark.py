@@ -0,0 +1,238 @@
+"""Performance benchmarks for each stage of the tracking process.
+
+Synthetic movies of Brownian "particles" are generated with known positions,
+as in the tests. Each stage of track2disk() is then timed separately, frame by
+frame, and the results written to a JSON file, so that different versions of
+the code can be compared.
+
+Example:
+    results = run_benchmarks([dict(size=512, nframes=20),
+                              dict(size=2048, nframes=5, density=0.002)],
+                             'bench.json')
+    compare_benchmarks('bench-old.json', 'bench.json')
+
+Or from the command line:
+    python -m runtrackpy.benchmark bench.json
+
+Peak memory is the maximum resident size of this process, as reported by the
+operating system after each stage. Since it never decreases, run configurations
+in order of increasing size, or in separate processes, for meaningful numbers.
+"""
+# Copyright 2013 Nathan C. Keim
+#
+#This program is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 3 of the License, or (at
+#your option) any later version.
+#
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+#General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, see <http://www.gnu.org/licenses>.
+
+import os, sys, time, json, tempfile, shutil, platform, subprocess, resource
+import numpy as np
+import scipy.misc
+import pandas
+
+from . import track, identification
+
+# Defaults for a benchmark configuration
+DEFAULT_CONFIG = dict(
+        size=512, # Frame width and height, in pixels
+        nframes=10,
+        density=0.001, # Particles per square pixel
+        maxdisp=2., # Largest displacement of a particle between frames, in pixels
+        seed=1,
+        params=dict(bright=1, featsize=5, bphigh=2, threshold=0.5, maxdisp=3 * np.sqrt(8),
+            merge_cutoff=2),
+        storage={},
+        )
+
+STAGES = ['imread', 'band_pass', 'find_local_max', 'subpixel_centroid',
+        'merge_groups', 'link_dataframes', 'hdf5_append']
+
+def fake_movie(size=512, nframes=10, density=0.001, maxdisp=2., seed=1):
+    """Generate a movie of particles undergoing random displacements.
+
+    Returns (list of image arrays, list of (N, 2) arrays of true x, y positions).
+    Particles are kept 20 px from the edges.
+    """
+    rs = np.random.RandomState(seed)
+    npart = max(int(density * size**2), 1)
+    pos = rs.uniform(20, size - 20, (npart, 2))
+    ims, truth = [], []
+    for i in range(nframes):
+        # gen_fake_data() wants coordinates in (row, column) order.
+        ims.append(identification.gen_fake_data(pos[:,::-1].T, 5, 2.5, (size, size)))
+        truth.append(pos.copy())
+        pos = np.clip(pos + rs.uniform(-maxdisp, maxdisp, pos.shape), 20, size - 20)
+    return ims, truth
+
+def peak_memory_mb():
+    """Maximum resident memory of this process so far, in MB."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # Bytes, not kB
+        return maxrss / 2.**20
+    return maxrss / 2.**10
+
+class _StageTimer(object):
+    """Accumulates time and peak memory for each named stage."""
+    def __init__(self):
+        self.seconds = dict((s, 0.) for s in STAGES)
+        self.peak_mb = {}
+    def run(self, stage, func, *args, **kw):
+        t0 = time.time()
+        result = func(*args, **kw)
+        self.seconds[stage] += time.time() - t0
+        self.peak_mb[stage] = peak_memory_mb()
+        return result
+    def results(self, nframes):
+        return dict((s, dict(seconds=round(self.seconds[s], 6),
+            frames_per_sec=round(nframes / self.seconds[s], 3) if self.seconds[s] else None,
+            peak_mb=round(self.peak_mb.get(s, 0), 1))) for s in STAGES)
+
+def benchmark(config=None, workdir=None):
+    """Run one benchmark configuration (see DEFAULT_CONFIG).
+
+    Returns a dict with the configuration, the timing of each stage, the
+    throughput of the complete track2disk() process, and the accuracy of the
+    identified positions.
+    """
+    cfg = dict(DEFAULT_CONFIG)
+    cfg.update(config or {})
+    params = track.compile_params(cfg['params'])
+    featsize = params.get('featsize', 3)
+    bplow = params.get('bplow', featsize)
+    bphigh = params.get('bphigh', 0.7)
+    threshold = params.get('threshold', 1e-15)
+    ims, truth = fake_movie(cfg['size'], cfg['nframes'], cfg['density'],
+            cfg['maxdisp'], cfg['seed'])
+    tmpdir = tempfile.mkdtemp(dir=workdir)
+    try:
+        filenames = []
+        for i, im in enumerate(ims):
+            filenames.append(os.path.join(tmpdir, 'bench_%.5i.png' % i))
+            scipy.misc.imsave(filenames[-1], im)
+        del ims
+        timer = _StageTimer()
+        workspace = identification.thread_workspace()
+        features, errors, nfound = [], [], 0
+        for fnum, filename in enumerate(filenames):
+            im = timer.run('imread', track.imread, filename, params)
+            if params.get('bright', 0):
+                im = 1 - im
+            imbp = timer.run('band_pass', identification.band_pass, im, bplow, bphigh,
+                    workspace=workspace)
+            lm = timer.run('find_local_max', identification.find_local_max, imbp,
+                    featsize, threshold=threshold,
+                    engine=params.get('lm_engine', 'auto'), workspace=workspace)
+            def centroid():
+                lmcrop = identification.local_max_crop(imbp, lm, featsize)
+                return identification.subpixel_centroid(imbp, lmcrop, featsize,
+                        struct_shape='circle')
+            pos, m, r2 = timer.run('subpixel_centroid', centroid)
+            ftr = pandas.DataFrame({'x': pos[0,:], 'y': pos[1,:], 'intensity': m, 'rg2': r2})
+            if params.get('merge_cutoff', -1) > 0:
+                ftr = timer.run('merge_groups', track.merge_groups, ftr,
+                        params['merge_cutoff'])
+            features.append((fnum + 1, ftr))
+            # Accuracy
+            if len(ftr):
+                dist, idx = track.cKDTree(ftr[['x', 'y']].values).query(truth[fnum])
+                found = dist < 1
+                nfound += found.sum()
+                errors.extend(dist[found])
+        linked = timer.run('link_dataframes',
+                lambda: list(track.link_dataframes(features, params)))
+        outfile = os.path.join(tmpdir, 'bench_tracks.h5')
+        writer = track._TracksWriter(outfile, len(linked), cfg['storage'])
+        try:
+            for (fnum, ftr), tracked in zip(features, linked):
+                timer.run('hdf5_append', writer.append, fnum, tracked)
+            timer.run('hdf5_append', writer.finish)
+            storage_stats = writer.stats()
+        finally:
+            writer.close()
+        # Complete process
+        os.remove(outfile)
+        t0 = time.time()
+        track.track2disk(filenames, outfile, params, storage=cfg['storage'])
+        total_seconds = time.time() - t0
+    finally:
+        shutil.rmtree(tmpdir)
+    ntrue = sum(len(t) for t in truth)
+    return dict(config=cfg,
+            particles_per_frame=len(truth[0]),
+            stages=timer.results(len(filenames)),
+            track2disk=dict(seconds=round(total_seconds, 6),
+                frames_per_sec=round(len(filenames) / total_seconds, 3),
+                peak_mb=round(peak_memory_mb(), 1)),
+            storage=storage_stats,
+            accuracy=dict(fraction_found=nfound / float(ntrue),
+                rms_error=float(np.sqrt(np.mean(np.square(errors)))) if errors else None))
+
+def environment_info():
+    """Versions of Python, libraries, and this code, for comparing results."""
+    import scipy, tables
+    info = dict(python=platform.python_version(), platform=platform.platform(),
+            numpy=np.__version__, scipy=scipy.__version__, pandas=pandas.__version__,
+            tables=tables.__version__, time=time.strftime('%Y-%m-%d %H:%M:%S'))
+    try:
+        info['commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['commit'] = None
+    return info
+
+def run_benchmarks(configs=None, outfilename=None, workdir=None):
+    """Run a list of benchmark configurations (default: one, with the defaults).
+
+    Returns a dict of environment info and results, and if 'outfilename' is
+    given, writes it there as JSON.
+    """
+    if configs is None:
+        configs = [{}]
+    report = dict(environment=environment_info(),
+            results=[benchmark(cfg, workdir=workdir) for cfg in configs])
+    if outfilename is not None:
+        with open(outfilename, 'w') as outfile:
+            json.dump(report, outfile, indent=4, separators=(',', ': '),
+                    default=_json_default)
+    return report
+
+def _json_default(obj):
+    """Convert numpy scalars for JSON."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(repr(obj))
+
+def summarize(report):
+    """DataFrame of frames/sec for each stage (columns) and configuration (rows).
+
+    'report' is the output of run_benchmarks(), or the name of its JSON file."""
+    if not isinstance(report, dict):
+        report = json.load(open(report))
+    rows = []
+    for result in report['results']:
+        row = dict((s, result['stages'][s]['frames_per_sec']) for s in STAGES)
+        row['track2disk'] = result['track2disk']['frames_per_sec']
+        row['peak_mb'] = result['track2disk']['peak_mb']
+        rows.append(row)
+    return pandas.DataFrame(rows, columns=STAGES + ['track2disk', 'peak_mb'])
+
+def compare_benchmarks(before, after):
+    """Ratio of throughput and memory in 'after' to that in 'before'.
+
+    Both are reports or JSON filenames with the same configurations. Values
+    below 1 for a stage (or above 1 for 'peak_mb') indicate a regression.
+    """
+    return summarize(after) / summarize(before)
+
+if __name__ == '__main__':
+    report = run_benchmarks(outfilename=sys.argv[1] if len(sys.argv) > 1 else None)
+    print summarize(report)
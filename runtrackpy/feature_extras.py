@@ -18,6 +18,17 @@ from . import identification
 from .track import postprocess_features
 import pandas
 
+def _donut_kernels(sm_width, lg_radius, lg_width):
+    """Make the small (Gaussian) and large (annulus) kernels for mixed_donuts()."""
+    fr = int((lg_radius + lg_width) * 3)
+    r = np.sqrt(np.sum(np.mgrid[-fr:fr+1,-fr:fr+1]**2, 0)) # Radius values for kernels
+
+    imfilt_sm = np.exp(-((r / sm_width)**2)) # Gaussian
+    imfilt_sm = imfilt_sm / np.abs(np.sum(imfilt_sm)) # Normalize
+
+    imfilt_lg = np.exp(-((r - lg_radius) / lg_width)**2) # Annulus
+    imfilt_lg = imfilt_lg / np.abs(np.sum(imfilt_lg)) # Normalize
+    return imfilt_sm, imfilt_lg
 def mixed_donuts(im, params, window=None, diag=False):
     """Perform a hybrid feature identification on a mixture of 2 kinds of particles:
     Small, Gaussian-like particles, and larger donut-like particles (e.g. with a
@@ -44,14 +55,9 @@ def mixed_donuts(im, params, window=None, diag=False):
     subpix_hipass = featsize - 1 # sharpen for subpixel centroid-finding.
 
     # Set up filter kernels
-    fr = int((lg_radius + lg_width) * 3)
-    r = np.sqrt(np.sum(np.mgrid[-fr:fr+1,-fr:fr+1]**2, 0)) # Radius values for kernels
-
-    imfilt_sm = np.exp(-((r / sm_width)**2)) # Gaussian
-    imfilt_sm = imfilt_sm / np.abs(np.sum(imfilt_sm)) # Normalize
-
-    imfilt_lg = np.exp(-((r - lg_radius) / lg_width)**2) # Annulus
-    imfilt_lg = imfilt_lg / np.abs(np.sum(imfilt_lg)) # Normalize
+    imfilt_sm, imfilt_lg = identification.struct_cache.get(
+            ('donut_kernels', sm_width, lg_radius, lg_width),
+            lambda: _donut_kernels(sm_width, lg_radius, lg_width))
 
     #### Start image processing
     # Make image values relative to some local mean intensity
@@ -62,8 +68,8 @@ def mixed_donuts(im, params, window=None, diag=False):
 
     # Convolve with each of the 2 kernel shapes and then use the strongest
     # signals from each
-    imcon_sm = ndimage.filters.convolve(im_uniform, imfilt_sm)
-    imcon_lg = ndimage.filters.convolve(im_uniform, imfilt_lg)
+    imcon_sm = identification.convolve(im_uniform, imfilt_sm)
+    imcon_lg = identification.convolve(im_uniform, imfilt_lg)
     imcon = np.fmax(imcon_sm, imcon_lg * lg_weight)
 
     # The hybrid image is spikey, but that's a good thing for local maxima.
@@ -0,0 +1,191 @@
+"""Persistent storage of identified features, so that a movie can be relinked
+without identifying its features again.
+
+A FeatureStore is an HDF5 file. Features for each set of identification
+parameters are kept in their own group, and the features of each image are
+found by a key that identifies the image file (see image_key()). Parameters
+that only affect linking ('maxdisp', 'memory', 'predict', etc.) are not part
+of the key, so changing them does not invalidate stored features.
+
+To use a store with track2disk():
+    track2disk(imgfiles, 'bigtracks.h5', params, feature_store='features.h5')
+Frames already in the store are not read or identified. With 'link_only', all
+frames must already be in the store. Features are also found by the path of
+their image (see path_key()), so that a movie can be relinked after its 
+images have been deleted or moved away.
+"""
+# Copyright 2013 Nathan C. Keim
+#
+#This program is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 3 of the License, or (at
+#your option) any later version.
+#
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+#General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, see <http://www.gnu.org/licenses>.
+
+import os, json, hashlib, itertools
+import pandas, tables
+
+from . import framesources
+
+# Parameters that do not affect identification
+NON_IDENTIFICATION_PARAMS = ('maxdisp', 'memory', 'predict', 'predict_channel_bin_size',
+        'predictor', 'tile_workers', 'lm_engine')
+
+# Parts of a window that affect the features found in a frame
+WINDOW_KEYS = ('xmin', 'xmax', 'ymin', 'ymax', 'zmin', 'zmax')
+
+def params_key(params, window=None):
+    """Hash of the parameters (and spatial extent of 'window') that determine 
+    identification."""
+    from .track import compile_params, get_window
+    params = compile_params(params)
+    if window == 'file':
+        window = get_window()
+    ident = dict((k, v) for k, v in params.items() if k not in NON_IDENTIFICATION_PARAMS)
+    if isinstance(window, dict): # Frame limits don't change any frame's features.
+        window = dict((k, float(v)) for k, v in window.items() if k in WINDOW_KEYS)
+    return hashlib.sha1(json.dumps([ident, window], sort_keys=True)).hexdigest()
+
+def image_key(filename, content=False):
+    """Key that identifies an image file (or a frame in a stack file).
+
+    By default, this is a hash of the file's absolute path, size and
+    modification time, which is cheap. If 'content', the file's contents
+    are hashed instead, which survives copying and renaming.
+    """
+    index = None
+    if isinstance(filename, framesources.FrameRef):
+        filename, index = filename.source.filename, filename.index
+    elif isinstance(filename, (list, tuple)): # Slices of a volume
+        return hashlib.sha1(''.join(image_key(fn, content) for fn in filename)).hexdigest()
+    h = hashlib.sha1()
+    if content and index is None:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), ''):
+                h.update(chunk)
+    else:
+        # Hashing a whole stack for every frame would be too slow.
+        st = os.stat(filename)
+        h.update(json.dumps([os.path.abspath(filename), st.st_size, st.st_mtime]))
+    if index is not None:
+        h.update(':%i' % index)
+    return h.hexdigest()
+
+def path_key(filename):
+    """Key that identifies an image only by its path (and index in a stack),
+    for finding features after the image is gone."""
+    if isinstance(filename, framesources.FrameRef):
+        path = [filename.source.filename, filename.index]
+    elif isinstance(filename, (list, tuple)): # Slices of a volume
+        path = [os.path.abspath(fn) for fn in filename]
+    else:
+        path = os.path.abspath(filename)
+    return hashlib.sha1(json.dumps(path)).hexdigest()
+
+class FeatureRow(tables.IsDescription):
+    x = tables.Float32Col(pos=1)
+    y = tables.Float32Col(pos=2)
+    intensity = tables.Float32Col(pos=3)
+    rg2 = tables.Float32Col(pos=4)
+class FeatureRow3D(tables.IsDescription):
+    x = tables.Float32Col(pos=1)
+    y = tables.Float32Col(pos=2)
+    z = tables.Float32Col(pos=3)
+    intensity = tables.Float32Col(pos=4)
+    rg2 = tables.Float32Col(pos=5)
+class FrameRow(tables.IsDescription):
+    image_key = tables.StringCol(40, pos=1)
+    start = tables.Int64Col(pos=2)
+    stop = tables.Int64Col(pos=3)
+    path_key = tables.StringCol(40, pos=4)
+
+class FeatureStore(object):
+    """Features identified with 'params' and 'window', stored in HDF5 file 'filename'.
+
+    If 'content_hash', images are recognized by their contents rather than
+    their names and modification times; see image_key().
+
+    Only the columns 'x', 'y', 'z' (if present), 'intensity', and 'rg2' are stored.
+    """
+    def __init__(self, filename, params, window=None, content_hash=False, mode='a'):
+        self.filename = filename
+        self.content_hash = content_hash
+        self.key = params_key(params, window)
+        self.h5 = tables.openFile(filename, mode)
+        self.groupname = 'p_' + self.key[:16]
+        self.features = self.frames = None
+        self.index = {} # image key -> (start, stop)
+        self.path_index = {} # path key -> image key
+        if self.groupname in self.h5.root:
+            group = self.h5.getNode('/', self.groupname)
+            self.frames = group.frames
+            frames = self.frames.read()
+            self.index = dict((k, (start, stop)) for k, start, stop in 
+                    itertools.izip(frames['image_key'], frames['start'], frames['stop']))
+            if 'path_key' in self.frames.colnames: # Not in older stores
+                self.path_index = dict(itertools.izip(frames['path_key'], 
+                    frames['image_key']))
+            if 'features' in group:
+                self.features = group.features
+        elif mode != 'r':
+            group = self.h5.createGroup('/', self.groupname)
+            group._v_attrs.params = json.dumps(
+                    dict((k, v) for k, v in params.items() if k != 'predictor'),
+                    default=repr)
+            self.frames = self.h5.createTable(group, 'frames', FrameRow)
+    def image_key(self, filename):
+        """image_key() for 'filename', or if it no longer exists, the key 
+        stored for its path."""
+        try:
+            return image_key(filename, self.content_hash)
+        except (IOError, OSError):
+            key = self.path_index.get(path_key(filename))
+            if key is None:
+                raise
+            return key
+    def __contains__(self, filename):
+        return self.image_key(filename) in self.index
+    def get(self, filename, key=None):
+        """DataFrame of features stored for 'filename', or None.
+        'key' may be given if it is already known."""
+        if key is None:
+            key = self.image_key(filename)
+        rng = self.index.get(key)
+        if rng is None:
+            return None
+        if self.features is None: # Only empty frames so far
+            return pandas.DataFrame({'x': [], 'y': [], 'intensity': [], 'rg2': []})
+        return pandas.DataFrame(self.features.read(*rng)).astype(float)
+    def put(self, filename, ftr, key=None):
+        """Store the features DataFrame 'ftr' for 'filename'."""
+        if key is None:
+            key = self.image_key(filename)
+        if self.features is None and len(ftr):
+            group = self.h5.getNode('/', self.groupname)
+            description = FeatureRow3D if 'z' in ftr else FeatureRow
+            self.features = self.h5.createTable(group, 'features', description)
+        if self.features is not None:
+            start = self.features.nrows
+            if len(ftr):
+                self.features.append(ftr[list(self.features.colnames)].values.astype('float32'))
+            stop = self.features.nrows
+        else:
+            start = stop = 0
+        if 'path_key' in self.frames.colnames:
+            pkey = path_key(filename)
+            self.frames.append([(key, start, stop, pkey)])
+            self.path_index[pkey] = key
+        else:
+            self.frames.append([(key, start, stop)])
+        self.index[key] = (start, stop)
+    def flush(self):
+        self.h5.flush()
+    def close(self):
+        self.h5.close()
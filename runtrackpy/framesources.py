@@ -0,0 +1,280 @@
+"""Sources of movie frames other than one image file per frame.
+
+A FrameSource is a sequence of raw frames, indexed from 0. Indexing it returns
+the frame exactly as stored, which for the memory-mapped sources below is a
+view on the file and costs no copying. Normalization to the range (0, 1),
+according to 'maxgray', is done only when a frame is read for tracking.
+
+To track a stack, pass it to track.track2disk() in place of a list of files:
+    track2disk(open_stack('movie.tif'), 'bigtracks.h5', params)
+
+Supported formats:
+    NpyStack: A 3D array in NumPy's ".npy" format.
+    RawStack: Headerless binary data. You must specify the frame shape and dtype.
+    TiffStack: A multipage TIFF. Requires the 'tifffile' module.
+
+For volumetric (3D) tracking, each "frame" is a z-stack. A 4D ".npy" array or a
+raw file with 3D frame shape can be used directly; VolumeStack groups the 2D 
+slices of any other source into volumes.
+"""
+# Copyright 2013 Nathan C. Keim
+#
+#This program is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 3 of the License, or (at
+#your option) any later version.
+#
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+#General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, see <http://www.gnu.org/licenses>.
+
+import os, threading, collections
+import numpy as np
+
+STACK_EXTENSIONS = ('.npy', '.tif', '.tiff', '.raw', '.bin')
+
+def normalize_image(imraw, params=None):
+    """Scale raw image data to the range (0, 1).
+    Uses "maxgray" in 'params', if available; otherwise guesses from the dtype.
+    If 'float32' in 'params' is true, the result is single precision.
+    """
+    if params is None: params = {}
+    mg = float(params.get('maxgray', 0))
+    if not mg: # Guess
+        if imraw.dtype.name == 'uint8':
+            mg = 2**8 - 1
+        elif imraw.dtype.name == 'uint16':
+            mg = 2**16 - 1
+        elif imraw.dtype.name.startswith('float'):
+            mg = 1.0
+        else:
+            raise ValueError("Can't guess max gray value of image. Use parameter 'maxgray'.")
+    if int(params.get('float32', 0)):
+        return np.true_divide(imraw, mg, dtype=np.float32)
+    return imraw / float(mg)
+
+# Handles of sources that are expensive to open, shared within each process
+MAX_SHARED_HANDLES = 8
+_shared_handles = collections.OrderedDict()
+_shared_handles_lock = threading.Lock()
+def _shared_handle(key, opener, closer):
+    """The handle for 'key' in this process, opened with 'opener()' if it is
+    not already open. The least recently used handles are closed with 'closer'."""
+    # A forked child must not share its parent's open files.
+    key = (os.getpid(),) + key
+    with _shared_handles_lock:
+        entry = _shared_handles.pop(key, None)
+        if entry is None:
+            entry = (opener(), closer)
+            while len(_shared_handles) >= MAX_SHARED_HANDLES:
+                oldkey, (oldhandle, oldcloser) = _shared_handles.popitem(last=False)
+                if oldkey[0] == key[0]: # Leave the parent's files alone
+                    oldcloser(oldhandle)
+        _shared_handles[key] = entry
+        return entry[0]
+
+class FrameSource(object):
+    """Base class for a sequence of frames stored in a single file.
+
+    Subclasses implement _open() and _get(). The file is opened on first use,
+    and again after unpickling, so that sources can be sent to worker processes.
+    If '_shared' is True, each process keeps one handle per file, for all 
+    sources (and unpickled copies) that refer to it; see MAX_SHARED_HANDLES.
+    """
+    _shared = False
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self._handle = None
+    def _open(self):
+        """Return an object for _get() to use."""
+        raise NotImplementedError
+    def _get(self, handle, index):
+        """Return frame 'index' as stored."""
+        raise NotImplementedError
+    def _nframes(self, handle):
+        raise NotImplementedError
+    def _close(self, handle):
+        """Release a handle from _open(), for shared handles."""
+        pass
+    def _array(self, handle):
+        """The whole stack as one (memory-mapped) array, or None if not available."""
+        return None
+    def _ensure_open(self):
+        if self._shared:
+            return _shared_handle((self.__class__.__name__, self.filename), 
+                    self._open, self._close)
+        if self._handle is None:
+            self._handle = self._open()
+        return self._handle
+    def __len__(self):
+        return self._nframes(self._ensure_open())
+    def __getitem__(self, index):
+        """Raw frame 'index' (counting from 0), without copying where possible."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Frame index out of range')
+        return self._get(self._ensure_open(), index)
+    def read(self, index, params=None):
+        """Frame 'index' (counting from 0), normalized as by track.imread()."""
+        return normalize_image(self[index], params)
+    def frame_refs(self):
+        """List of references to each frame, which stand in for image filenames."""
+        return [FrameRef(self, i) for i in range(len(self))]
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_handle'] = None
+        return state
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.filename)
+
+class FrameRef(object):
+    """A single frame in a FrameSource. Accepted by track.imread() in place of a filename."""
+    def __init__(self, source, index):
+        self.source = source
+        self.index = index
+    def read(self, params=None):
+        return self.source.read(self.index, params)
+    def __str__(self):
+        return '%s[%i]' % (self.source.filename, self.index)
+    __repr__ = __str__
+
+class NpyStack(FrameSource):
+    """Memory-mapped array stored with numpy.save(). Frames are along the first axis.
+    
+    A 4D array is a stack of volumes."""
+    def _open(self):
+        arr = np.load(self.filename, mmap_mode='r')
+        if arr.ndim not in (3, 4):
+            raise ValueError('Expected a 3D or 4D array in "%s"' % self.filename)
+        return arr
+    def _get(self, arr, index):
+        return arr[index]
+    def _nframes(self, arr):
+        return arr.shape[0]
+    def _array(self, arr):
+        return arr
+
+class RawStack(FrameSource):
+    """Memory-mapped, headerless binary file of consecutive frames.
+
+    'shape' is the (rows, columns) shape of each frame, or (slices, rows, columns)
+    for volumes. 'dtype' is the
+    pixel type (e.g. 'uint16', or '>u2' for big-endian). 'offset' is the
+    number of header bytes to skip. Trailing partial frames are ignored.
+    """
+    def __init__(self, filename, shape, dtype='uint16', offset=0):
+        FrameSource.__init__(self, filename)
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.offset = int(offset)
+    def _open(self):
+        framebytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        nframes = (os.path.getsize(self.filename) - self.offset) // framebytes
+        return np.memmap(self.filename, dtype=self.dtype, mode='r',
+                offset=self.offset, shape=(nframes,) + self.shape)
+    def _get(self, arr, index):
+        return arr[index]
+    def _nframes(self, arr):
+        return arr.shape[0]
+    def _array(self, arr):
+        return arr
+
+class TiffStack(FrameSource):
+    """Multipage TIFF file, one frame per page.
+
+    If the pages are uncompressed and stored contiguously, the whole file is
+    memory-mapped, read-only. Otherwise, each page is decoded when it is 
+    requested. Parsing the page headers of a large file is slow, so the file
+    is opened once in each process and shared.
+    """
+    _shared = True
+    def _open(self):
+        import tifffile
+        tif = tifffile.TiffFile(self.filename)
+        try:
+            mm = tifffile.memmap(self.filename, mode='r')
+        except ValueError: # Not memory-mappable
+            mm = None
+        else:
+            if mm.ndim == 2: # Single page
+                mm = mm[np.newaxis]
+            if mm.shape[0] != len(tif.pages):
+                mm = None
+        return tif, mm
+    def _get(self, handle, index):
+        tif, mm = handle
+        if mm is not None:
+            return mm[index]
+        return tif.pages[index].asarray()
+    def _nframes(self, handle):
+        return len(handle[0].pages)
+    def _close(self, handle):
+        handle[0].close()
+    def _array(self, handle):
+        return handle[1]
+
+class VolumeStack(FrameSource):
+    """Volumes made from consecutive groups of 'nz' 2D frames in 'source'.
+
+    Volumes are views on the memory map, if 'source' has one.
+    Trailing frames that don't make a complete volume are ignored.
+    """
+    def __init__(self, source, nz):
+        FrameSource.__init__(self, source.filename)
+        self.source = source
+        self.nz = int(nz)
+    def _open(self):
+        return self.source
+    def _get(self, source, index):
+        start, stop = index * self.nz, (index + 1) * self.nz
+        arr = source._array(source._ensure_open())
+        if arr is not None:
+            return arr[start:stop]
+        return np.array([source[i] for i in range(start, stop)])
+    def _nframes(self, source):
+        return len(source) // self.nz
+    def __repr__(self):
+        return '%s(%r, %i)' % (self.__class__.__name__, self.source, self.nz)
+
+def open_stack(filename, params=None):
+    """Open 'filename' as a FrameSource, according to its extension.
+
+    For raw binary files (".raw" or ".bin"), 'params' must contain 'frame_width'
+    and 'frame_height', and may contain 'raw_dtype' (default 'uint16') and
+    'raw_offset' (header bytes, default 0).
+
+    If 'params' contains 'zslices', every 'zslices' consecutive 2D frames are 
+    grouped into a volume, for 3D tracking.
+    """
+    if params is None: params = {}
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.npy':
+        source = NpyStack(filename)
+    elif ext in ('.tif', '.tiff'):
+        source = TiffStack(filename)
+    elif ext in ('.raw', '.bin'):
+        try:
+            shape = (int(params['frame_height']), int(params['frame_width']))
+        except KeyError:
+            raise ValueError('Parameters "frame_width" and "frame_height" are required for raw files.')
+        source = RawStack(filename, shape, dtype=params.get('raw_dtype', 'uint16'),
+                offset=int(params.get('raw_offset', 0)))
+    else:
+        raise ValueError('Unrecognized stack format: "%s"' % filename)
+    if int(params.get('zslices', 0)):
+        source = VolumeStack(source, int(params['zslices']))
+    return source
+def is_stack_filename(filename):
+    """Whether 'filename' has an extension that open_stack() can handle."""
+    return os.path.splitext(filename)[1].lower() in STACK_EXTENSIONS
+def frame_list(frames):
+    """Convert a FrameSource or a list of filenames to a list that can
+    be passed to track.imread(), one item per frame."""
+    if isinstance(frames, FrameSource):
+        return frames.frame_refs()
+    return list(frames)
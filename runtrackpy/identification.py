@@ -21,10 +21,141 @@ import numpy.random as npr
 import numba
 from scipy import ndimage
 
-import itertools
+import itertools, collections, threading
 
 
-def find_local_max(img, d_rad, threshold=1e-15, inplace=False):
+class StructCache(object):
+    """Bounded cache of structuring elements and masks, shared by the
+    functions in this module so that they are not rebuilt for every frame.
+
+    Keys are tuples beginning with the kind of object, e.g.
+    ('diamond', radius, dim). Up to 'maxsize' entries are kept; the least 
+    recently used is discarded first. Cached arrays must not be modified.
+
+    'hits' and 'misses' count lookups, so that the cache can be checked.
+    The cache may be used from several threads at once.
+    """
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    def get(self, key, factory):
+        """Return the item for 'key', calling 'factory()' to make it if needed."""
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+                self.hits += 1
+                self._items[key] = value
+                return value
+            except KeyError:
+                self.misses += 1
+        # Not holding the lock, since 'factory' may use the cache itself.
+        value = factory()
+        with self._lock:
+            self._items.pop(key, None) # In case another thread made it too
+            while len(self._items) >= self.maxsize:
+                self._items.popitem(last=False)
+            self._items[key] = value
+        return value
+    def info(self):
+        """Dict of hit and miss counts, and size."""
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self._items),
+                    maxsize=self.maxsize)
+    def clear(self):
+        """Empty the cache and reset the counters."""
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
+
+struct_cache = StructCache()
+
+class Workspace(object):
+    """Reusable arrays for processing a series of frames.
+
+    Functions in this module that accept a 'workspace' write their intermediate
+    (and sometimes final) results into its buffers instead of allocating new 
+    arrays for every frame. Results returned in a workspace buffer are 
+    overwritten by the next call, so copy anything you want to keep.
+    """
+    def __init__(self):
+        self._buffers = {}
+    def buffer(self, name, shape, dtype=np.float64):
+        """Array named 'name' with 'shape' and 'dtype'. Contents are undefined."""
+        shape, dtype = tuple(shape), np.dtype(dtype)
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self._buffers[name] = np.empty(shape, dtype)
+        return buf
+    def nbytes(self):
+        """Total size of all buffers."""
+        return sum(buf.nbytes for buf in self._buffers.values())
+
+_thread_local = threading.local()
+def thread_workspace():
+    """A Workspace belonging to the current thread, kept between calls."""
+    try:
+        return _thread_local.workspace
+    except AttributeError:
+        _thread_local.workspace = Workspace()
+        return _thread_local.workspace
+
+def per_axis_radii(rad, dim):
+    """Tuple of 'dim' integer radii, from a scalar or a sequence (in axis order)."""
+    if np.ndim(rad) == 0:
+        return (int(rad),) * dim
+    rad = tuple(int(r) for r in rad)
+    if len(rad) != dim:
+        raise ValueError('Expected one radius for each of %i dimensions' % dim)
+    return rad
+def diamond_struct(d_rad, dim):
+    """Diamond-shaped (taxicab) structuring element of radius 'd_rad', from the cache.
+
+    'd_rad' may also be a sequence of radii, one for each axis, which stretches
+    the diamond accordingly.
+    """
+    radii = per_axis_radii(d_rad, dim)
+    def make():
+        if len(set(radii)) == 1:
+            s = ndimage.generate_binary_structure(dim, 1)
+            # scale it up to the desired size
+            return ndimage.iterate_structure(s, radii[0])
+        so = [slice(-r, r + 1) for r in radii]
+        return np.sum([np.abs(o) / float(max(r, 1)) 
+            for o, r in zip(np.mgrid[so], radii)], 0) <= 1
+    return struct_cache.get(('diamond', radii), make)
+def _centroid_masks(mask_rad, dim, struct_shape):
+    """(d_struct, offset_masks, r2_mask) for subpixel_centroid(), from the cache.
+    
+    'mask_rad' may be a sequence of radii, one for each axis."""
+    radii = per_axis_radii(mask_rad, dim)
+    def make():
+        so = [slice(-r, r + 1) for r in radii]
+        # Make circular structuring element
+        if struct_shape == 'circle':
+            if len(set(radii)) == 1:
+                d_struct = (np.sum(np.mgrid[so]**2, 0) <= radii[0]**2).astype(np.int8)
+            else: # Ellipse
+                d_struct = (np.sum([(o / float(max(r, 1)))**2 
+                    for o, r in zip(np.mgrid[so], radii)], 0) <= 1).astype(np.int8)
+        elif struct_shape == 'diamond':
+            d_struct = diamond_struct(radii, dim)
+        else: raise ValueError('Shape must be diamond or circle')
+        
+        offset_masks = np.array([d_struct * os for os in np.mgrid[so]]).astype(np.int8)
+        
+        r2_mask = np.zeros(d_struct.shape)
+        for o in offset_masks:
+            r2_mask += o ** 2
+        r2_mask = np.sqrt(r2_mask).astype(float)
+        return d_struct, offset_masks, r2_mask
+    return struct_cache.get(('centroid', radii, struct_shape), make)
+
+
+def find_local_max(img, d_rad, threshold=1e-15, inplace=False, engine='dense',
+        workspace=None):
     """
     This is effectively a replacement for pkfnd in the matlab/IDL code.
 
@@ -33,37 +164,127 @@ def find_local_max(img, d_rad, threshold=1e-15, inplace=False):
     The magic of numpy means this should work for any dimension data.
 
     :param img: an ndarray representing the data to find the local maxes
-    :param d_rad: the radius of the dilation, the smallest possible spacing between local maximum
+    :param d_rad: the radius of the dilation, the smallest possible spacing between local maximum.
+        May be a sequence of radii, in axis order, for anisotropic data.
     :param threshold: optional, voxels < threshold are ignored.
     :param inplace: If True, `img` is modified.
+    :param engine: 'dense' dilates the whole image. 'sparse' first finds pixels that
+        are maxima among their nearest neighbors, and then checks only those. 'auto'
+        uses 'sparse' when there are few such candidates. All give identical results.
+    :param workspace: optional :py:class:`Workspace` for temporary arrays.
 
     :rtype: (d,N) array of the local maximums.
     """
-    d_rad = int(d_rad)
     # knock out singleton dimensions, 
     # and prepare to change values in thresholding step.
-    img = np.array(np.squeeze(img))
-    if not inplace:
-        img = img.copy() # Otherwise we could mess up use of 'img' by subsequent code.
+    if workspace is None:
+        img = np.array(np.squeeze(img))
+        if not inplace:
+            img = img.copy() # Otherwise we could mess up use of 'img' by subsequent code.
+    else:
+        img_orig = np.squeeze(img)
+        img = workspace.buffer('find_local_max', img_orig.shape, img_orig.dtype)
+        img[...] = img_orig
     img[img < threshold] = -np.inf        # mask out pixels below threshold
     dim = img.ndim                        # get the dimension of data
+    radii = per_axis_radii(d_rad, dim)
+
+    if engine not in ('dense', 'sparse', 'auto'):
+        raise ValueError('engine must be "dense", "sparse", or "auto"')
+    if engine != 'dense' and min(radii) >= 1:
+        candidates = _local_max_candidates(img)
+        if engine == 'sparse' or len(candidates[0]) * _SPARSE_COST < img.size:
+            local_max = _check_local_max_candidates(img, candidates, radii)
+            return np.vstack(local_max[::-1])
 
     # make structuring element
-    s = ndimage.generate_binary_structure(dim, 1)
-    # scale it up to the desired size
-    d_struct = ndimage.iterate_structure(s, int(d_rad))
-    dilated_img = ndimage.grey_dilation(img,
-                                        footprint=d_struct,
-                                        cval=0,
-                                        mode='constant')   # do the dilation
+    d_struct = diamond_struct(radii, dim)
+    if workspace is None:
+        dilated_img = ndimage.grey_dilation(img,
+                                            footprint=d_struct,
+                                            cval=0,
+                                            mode='constant')   # do the dilation
+    else:
+        dilated_img = workspace.buffer('find_local_max_dilated', img.shape, img.dtype)
+        ndimage.grey_dilation(img, footprint=d_struct, cval=0, mode='constant',
+                output=dilated_img)
 
     # find the locations that are the local maximum
-    # TODO clean this up
-    local_max = np.where(np.exp(img - dilated_img) > (1 - 1e-15))
+    local_max = np.where(_is_local_max(img, dilated_img, 
+        scratch=None if workspace is None else dilated_img))
     # the extra [::-1] is because matplotlib and ndimage disagree an xy vs yx.
     # Finally, there should be nothing within 'd_rad' of the edges of the image
     return np.vstack(local_max[::-1])
 
+def _is_local_max(values, maxvalues, scratch=None):
+    """The test for a local maximum in find_local_max(). 'maxvalues' are the
+    maxima of the neighborhoods of 'values'. 
+    
+    'scratch' may be an array with the same shape as 'values' (possibly 'maxvalues'
+    itself), to be overwritten."""
+    if values.dtype != np.float64:
+        # 1 - 1e-15 would round to 1, so compare directly.
+        return (values >= maxvalues) & (values != -np.inf)
+    if scratch is None:
+        return np.exp(values - maxvalues) > (1 - 1e-15)
+    np.subtract(values, maxvalues, scratch)
+    np.exp(scratch, scratch)
+    return scratch > (1 - 1e-15)
+
+# Rough cost of checking one candidate in find_local_max(engine='sparse'), 
+# relative to processing one pixel with the dense method.
+_SPARSE_COST = 10
+def _local_max_candidates(img):
+    """Indices of pixels in 'img' that could be local maxima, because they
+    are no smaller than any of their 2*dim nearest neighbors.
+
+    'img' has already been thresholded. As in grey_dilation() in find_local_max(),
+    pixels outside the image have value 0. The criterion is slightly looser than
+    the one in find_local_max(), so that no true maximum is excluded.
+    """
+    nbmax = np.empty_like(img)
+    nbmax.fill(-np.inf)
+    for ax in range(img.ndim):
+        lower = [slice(None)] * img.ndim
+        upper = list(lower)
+        lower[ax] = slice(None, -1)
+        upper[ax] = slice(1, None)
+        lower, upper = tuple(lower), tuple(upper)
+        np.maximum(nbmax[upper], img[lower], nbmax[upper])
+        np.maximum(nbmax[lower], img[upper], nbmax[lower])
+        for edge in (0, -1):
+            edgeslice = [slice(None)] * img.ndim
+            edgeslice[ax] = edge
+            edgeslice = tuple(edgeslice)
+            np.maximum(nbmax[edgeslice], 0, nbmax[edgeslice])
+    with np.errstate(invalid='ignore'): # -inf - -inf
+        nbmax -= img # Now the deficit of each pixel relative to its neighbors
+        return np.nonzero(nbmax < -2 * np.log(1 - 1e-15))
+def _check_local_max_candidates(img, candidates, radii, chunksize=2**16):
+    """Apply the test in find_local_max() to just the pixels at 'candidates'.
+    'radii' has the radius of the footprint along each axis.
+
+    Returns the subset of 'candidates' that are local maxima, in the same order.
+    """
+    dim = img.ndim
+    radii = np.array(per_axis_radii(radii, dim))
+    candidates = np.array(candidates, dtype=np.intp).reshape((dim, -1))
+    offsets = np.transpose(np.nonzero(diamond_struct(tuple(radii), dim))) - radii
+    # Pad with the 'cval' used by grey_dilation().
+    padded = np.zeros([n + 2 * r for n, r in zip(img.shape, radii)], dtype=img.dtype)
+    padded[tuple(slice(r, r + n) for n, r in zip(img.shape, radii))] = img
+    flat = padded.ravel()
+    elstrides = np.array(padded.strides) // padded.itemsize
+    base = np.dot(elstrides, candidates + radii[:, np.newaxis])
+    flatoffsets = np.dot(offsets, elstrides)
+    values = img[tuple(candidates)]
+    keep = np.zeros(candidates.shape[1], dtype=bool)
+    for start in range(0, candidates.shape[1], chunksize):
+        chunk = slice(start, start + chunksize)
+        nbmax = flat[base[chunk, np.newaxis] + flatoffsets].max(axis=1)
+        keep[chunk] = _is_local_max(values[chunk], nbmax)
+    return tuple(candidates[:, keep])
+
 @numba.autojit
 def _refine_centroids_loop(img, local_maxes, mask_rad, offset_masks, d_struct, r2_mask):
     results = np.zeros((4, local_maxes.shape[1]), dtype=np.float32)
@@ -99,11 +320,15 @@ def local_max_crop(img, local_maxes, mask_rad):
 def _local_max_within_bounds(shape, local_maxes, mask_rad):
     """Determine which of 'local_maxes' is within the bounds 'shape'.
     Return array with same length as axis 1 of local_maxes.
+
+    'mask_rad' may be a sequence of radii, in the same (axis) order as 'shape'.
     """
-    lm = local_maxes
-    return (lm[0,:] >= mask_rad) & (lm[1,:] >= mask_rad) & \
-            (lm[0,:] <= shape[1] - 1 - mask_rad) & \
-            (lm[1,:] <= shape[0] - 1 - mask_rad)
+    # local_maxes has coordinates in the opposite order from 'shape'.
+    lm = np.asarray(local_maxes)[::-1]
+    inbounds = np.ones(lm.shape[1], dtype=bool)
+    for coords, size, rad in zip(lm, shape, per_axis_radii(mask_rad, len(shape))):
+        inbounds &= (coords >= rad) & (coords <= size - 1 - rad)
+    return inbounds
 def subpixel_centroid(img, local_maxes, mask_rad, struct_shape='circle'):
     '''
     This is effectively a replacement for cntrd in the matlab/IDL code.
@@ -128,76 +353,64 @@ def subpixel_centroid(img, local_maxes, mask_rad, struct_shape='circle'):
     img = np.squeeze(img)                 # knock out singleton dimensions
     dim = img.ndim
     if dim > 2: raise ValueError('Use subpixel_centroid_nd() for dimension > 2')
-    so = [slice(-mask_rad, mask_rad + 1)] * dim
-    # Make circular structuring element
-    if struct_shape == 'circle':
-        d_struct = (np.sum(np.mgrid[so]**2, 0) <= mask_rad**2).astype(np.int8)
-    elif struct_shape == 'diamond':
-        s = ndimage.generate_binary_structure(dim, 1)
-        # scale it up to the desired size
-        d_struct = ndimage.iterate_structure(s, int(mask_rad))
-    else: raise ValueError('Shape must be diamond or circle')
-    
-    offset_masks = np.array([d_struct * os for os in np.mgrid[so]]).astype(np.int8)
-    
-    r2_mask = np.zeros(d_struct.shape)
-    for o in offset_masks:
-        r2_mask += o ** 2
-    r2_mask = np.sqrt(r2_mask).astype(float)
+    d_struct, offset_masks, r2_mask = _centroid_masks(int(mask_rad), dim, struct_shape)
     results = _refine_centroids_loop(img, local_maxes, mask_rad, offset_masks, d_struct, r2_mask)
     pos = (results[0:2,:] + local_maxes)[::-1,:]
     m = results[2,:]
     r2 = results[3,:]
     return pos, m, r2
 
-def subpixel_centroid_nd(img, local_maxes, mask_rad):
+def subpixel_centroid_nd(img, local_maxes, mask_rad, chunksize=2**14):
     '''
     This is effectively a replacement for cntrd in the matlab/IDL code.
 
-    Should work for any dimension data
+    Should work for any dimension data. Uses a diamond-shaped mask, and
+    gives the same results as :py:func:`~subpixel_centroid` with 
+    struct_shape='diamond'.
 
+    The windows around all local maxes are gathered into one array, 'chunksize'
+    at a time, and their moments computed together.
 
     :param img: the data
     :param local_maxes: a (d,N) array with the location of the local maximums (as generated by :py:func:`~find_local_max`)
-    :param mask_rad: the radius of the mask used for the averaging.
+    :param mask_rad: the radius of the mask used for the averaging. May be
+        a sequence of radii, in axis order, for anisotropic data.
 
-    :rtype: (d,N) array of positions, (d,) array of masses, (d,) array of r2,
+    :rtype: (d,N) array of positions, (N,) array of masses, (N,) array of r2,
     '''
-    local_maxes = local_maxes[::-1]
+    local_maxes = np.asarray(local_maxes)
     # do some data checking/munging
-    mask_rad = int(mask_rad)
-    img = np.squeeze(img)                 # knock out singleton dimensions
-    # make sure local_maxes.shape makes sense
+    img = np.ascontiguousarray(np.squeeze(img))  # knock out singleton dimensions
     dim = img.ndim
-    s = ndimage.generate_binary_structure(dim, 1)
-    # scale it up to the desired size
-    d_struct = ndimage.iterate_structure(s, int(mask_rad))
-
-    so = [slice(-mask_rad, mask_rad + 1)] * dim
-    offset_masks = [d_struct * os for os in np.mgrid[so]]
-
-    r2_mask = np.zeros(d_struct.shape)
-    for o in offset_masks:
-        r2_mask += o ** 2
-
-    r2_mask = np.sqrt(r2_mask)
-
-    shifts_lst = []
-    mass_lst = []
-    r2_lst = []
-    for loc in itertools.izip(*local_maxes):
-
-        window = [slice(p - mask_rad, p + mask_rad + 1) for p in loc]
-        img_win = img[window]
-        mass = np.sum(img_win * d_struct)
-        mass_lst.append(mass)
-        shifts_lst.append([np.sum(img_win * o) / mass for o in offset_masks])
-        r2_lst.append(np.sum(r2_mask * img_win))
-    sub_pixel = np.array(shifts_lst).T + local_maxes
-    return sub_pixel[::-1], mass_lst, r2_lst
-
-
-def band_pass(img, p_rad, hwhm):
+    mask_rad = per_axis_radii(mask_rad, dim)
+    if not _local_max_within_bounds(img.shape, local_maxes, mask_rad).all():
+        raise IndexError('One or more local maxes are too close to the image edge. Use local_max_crop().')
+    local_maxes = local_maxes[::-1].astype(np.intp) # Same coordinate order as img
+    d_struct, offset_masks, r2_mask = _centroid_masks(mask_rad, dim, 'diamond')
+
+    # Weights for each pixel in the mask, for mass, position, and r2 moments
+    inmask = np.nonzero(d_struct)
+    weights = np.column_stack([d_struct[inmask]] + [o[inmask] for o in offset_masks] +
+            [r2_mask[inmask]]).astype(float)
+    # Positions of mask pixels in the flattened image
+    elstrides = np.array(img.strides) // img.itemsize
+    flatoffsets = np.dot(np.transpose(inmask) - np.array(mask_rad), elstrides)
+    base = np.dot(elstrides, local_maxes)
+    flat = img.ravel()
+
+    nmax = local_maxes.shape[1]
+    moments = np.empty((nmax, dim + 2))
+    for start in range(0, nmax, chunksize):
+        chunk = slice(start, start + chunksize)
+        moments[chunk] = np.dot(flat[base[chunk, np.newaxis] + flatoffsets], weights)
+    mass = moments[:, 0]
+    shifts = moments[:, 1:dim + 1] / mass[:, np.newaxis]
+    r2 = moments[:, dim + 1]
+    sub_pixel = shifts.T + local_maxes
+    return sub_pixel[::-1], mass, r2
+
+
+def band_pass(img, p_rad, hwhm, workspace=None, normalize=True):
     '''
     Intended to be a replacement for bpass in the matlab/IDL code.
 
@@ -207,36 +420,161 @@ def band_pass(img, p_rad, hwhm):
     :param img: array of data
     :param p_rad: the size of the window used for the convolution
     :param hwhm: the hwhm of the Gaussian
+        (Either may be a sequence, with one value for each axis of 'img'.)
+    :param workspace: optional :py:class:`Workspace`. The result is then
+        returned in one of its buffers. Single-precision 'img' is processed
+        in single precision.
+    :param normalize: If False, the result is not scaled. Its minimum is
+        then 0 (unless 'img' is too small to have interior pixels), so that 
+        dividing by its maximum gives the normalized result.
     :rtype: :class:`numpy.ndarray` scaled between 0 and 1
     '''
-    # make sure the input data is an array and float type.
-    img = np.asarray(img).astype(float)
+    img = np.asarray(img)
 
-    p_dia = 2 * p_rad + 1
+    p_dia = [2 * r + 1 for r in per_axis_radii(p_rad, img.ndim)]
 
     # do the two convolutions.
     # These should maybe be replaced with masked kernels, but this is
     # faster to code up.
-    img_boxcar = ndimage.filters.uniform_filter(img, p_dia, mode='nearest', cval=0)
-    img_gaus = ndimage.filters.gaussian_filter(img, hwhm, mode='nearest', cval=0)
-
-    # subtract them
-    ret_img = img_boxcar - img_gaus
+    if workspace is not None and img.dtype in (np.float32, np.float64):
+        img_boxcar = workspace.buffer('band_pass_boxcar', img.shape, img.dtype)
+        ret_img = workspace.buffer('band_pass', img.shape, img.dtype)
+        ndimage.filters.uniform_filter(img, p_dia, output=img_boxcar, 
+                mode='nearest', cval=0)
+        ndimage.filters.gaussian_filter(img, hwhm, output=ret_img,
+                mode='nearest', cval=0)
+        # subtract them
+        np.subtract(img_boxcar, ret_img, ret_img)
+    else:
+        # make sure the input data is an array and float type.
+        img = img.astype(float)
+        img_boxcar = ndimage.filters.uniform_filter(img, p_dia, mode='nearest', cval=0)
+        img_gaus = ndimage.filters.gaussian_filter(img, hwhm, mode='nearest', cval=0)
+
+        # subtract them
+        ret_img = img_boxcar - img_gaus
 
     # kill data at edegs where the convolution leaked out
     ret_img[ret_img < 0] = 0
-    ret_img[:p_dia, :] = 0
-    ret_img[-p_dia:, :] = 0
-    ret_img[:, :p_dia] = 0
-    ret_img[:, -p_dia:] = 0
+    for ax, dia in enumerate(p_dia):
+        edge = [slice(None)] * ret_img.ndim
+        edge[ax] = slice(None, dia)
+        ret_img[tuple(edge)] = 0
+        edge[ax] = slice(-dia, None)
+        ret_img[tuple(edge)] = 0
 
     # normalize the image
-    ret_img -= np.min(ret_img)
-    ret_img /= np.max(ret_img)
+    if normalize:
+        ret_img -= np.min(ret_img)
+        ret_img /= np.max(ret_img)
 
     return ret_img
 
 
+# Kernels wider than this (in pixels) are applied with FFTs when method='auto'.
+_FFT_MIN_KERNEL = 51
+
+def band_pass_stack(imgs, p_rad, hwhm, method='auto', normalize=True):
+    '''
+    Apply :py:func:`~band_pass` to every frame in a (T, Y, X) block at once.
+
+    There is no smoothing along the first (time) axis. Each frame is normalized
+    separately.
+
+    :param imgs: (T, Y, X) array of data
+    :param p_rad: the size of the window used for the convolution
+    :param hwhm: the hwhm of the Gaussian
+    :param method: 'direct' uses the same filters as :py:func:`~band_pass`. 'fft'
+        applies the combined boxcar-minus-Gaussian kernel by FFT convolution,
+        which is faster for large kernels. 'auto' decides based on kernel size.
+        The methods agree to within floating-point roundoff.
+    :param normalize: If False, the frames are not scaled, as for :py:func:`~band_pass`.
+    :rtype: (T, Y, X) :class:`numpy.ndarray`, each frame scaled between 0 and 1
+    '''
+    imgs = np.asarray(imgs)
+    if imgs.dtype not in (np.float32, np.float64):
+        imgs = imgs.astype(float)
+    if imgs.ndim != 3:
+        raise ValueError('Expected a (T, Y, X) array')
+    p_dia = 2 * p_rad + 1
+    # Same truncation as ndimage.gaussian_filter()
+    g_rad = int(4.0 * hwhm + 0.5)
+    if method == 'auto':
+        method = 'fft' if 2 * max(p_rad, g_rad) + 1 >= _FFT_MIN_KERNEL else 'direct'
+    if method == 'direct':
+        img_boxcar = ndimage.filters.uniform_filter(imgs, (1, p_dia, p_dia), 
+                mode='nearest', cval=0)
+        img_gaus = ndimage.filters.gaussian_filter(imgs, (0, hwhm, hwhm), 
+                mode='nearest', cval=0)
+        ret_img = img_boxcar
+        ret_img -= img_gaus
+        del img_gaus
+    elif method == 'fft':
+        ret_img = fft_convolve(imgs, _band_pass_kernel(p_rad, hwhm), mode='nearest')
+    else:
+        raise ValueError('method must be "direct", "fft", or "auto"')
+
+    # kill data at edegs where the convolution leaked out
+    ret_img[ret_img < 0] = 0
+    ret_img[:, :p_dia, :] = 0
+    ret_img[:, -p_dia:, :] = 0
+    ret_img[:, :, :p_dia] = 0
+    ret_img[:, :, -p_dia:] = 0
+
+    # normalize each frame
+    if normalize:
+        flat = ret_img.reshape((ret_img.shape[0], -1))
+        flat -= flat.min(axis=1)[:, np.newaxis]
+        flat /= flat.max(axis=1)[:, np.newaxis]
+
+    return ret_img
+def _band_pass_kernel(p_rad, hwhm):
+    """2D kernel equivalent to the boxcar minus the Gaussian in band_pass(), from the cache."""
+    def make():
+        g_rad = int(4.0 * hwhm + 0.5)
+        rad = max(p_rad, g_rad)
+        kernel = np.zeros((2 * rad + 1,) * 2)
+        p_dia = 2 * p_rad + 1
+        kernel[rad - p_rad:rad + p_rad + 1, rad - p_rad:rad + p_rad + 1] = 1. / p_dia**2
+        # 1D weights as computed by ndimage.gaussian_filter1d()
+        x = np.arange(-g_rad, g_rad + 1)
+        g = np.exp(-0.5 * (x / float(hwhm))**2) if hwhm > 0 else (x == 0).astype(float)
+        g /= g.sum()
+        kernel[rad - g_rad:rad + g_rad + 1, rad - g_rad:rad + g_rad + 1] -= np.outer(g, g)
+        return kernel
+    return struct_cache.get(('band_pass_kernel', p_rad, hwhm), make)
+def fft_convolve(imgs, kernel, mode='reflect'):
+    '''
+    Convolve each 2D image in 'imgs' (which may have leading axes, e.g. time)
+    with the 2D 'kernel', using FFTs.
+
+    Gives the same result as ndimage.convolve() with the same 'mode', to within
+    roundoff. Supported modes are 'reflect', 'nearest', and 'constant' (with zeros).
+    '''
+    imgs = np.asarray(imgs)
+    kernel = np.asarray(kernel, dtype=float)
+    padmode = {'reflect': 'symmetric', 'nearest': 'edge', 'constant': 'constant'}[mode]
+    center = [k // 2 for k in kernel.shape]
+    pad = [(0, 0)] * (imgs.ndim - 2) + [(c, c) for c in center]
+    padded = np.pad(imgs, pad, mode=padmode)
+    fshape = padded.shape[-2:]
+    # Place the kernel's center at the origin, for circular convolution
+    kpad = np.zeros(fshape)
+    kpad[:kernel.shape[0], :kernel.shape[1]] = kernel
+    kpad = np.roll(np.roll(kpad, -center[0], axis=0), -center[1], axis=1)
+    result = np.fft.irfftn(np.fft.rfftn(padded, axes=(-2, -1)) * np.fft.rfftn(kpad), 
+            fshape, axes=(-2, -1))
+    crop = (Ellipsis, slice(center[0], center[0] + imgs.shape[-2]),
+            slice(center[1], center[1] + imgs.shape[-1]))
+    return np.ascontiguousarray(result[crop], 
+            dtype=imgs.dtype if imgs.dtype.kind == 'f' else float)
+def convolve(img, kernel, mode='reflect'):
+    """ndimage.convolve() for 2D images, using fft_convolve() for large kernels."""
+    if max(np.shape(kernel)) >= _FFT_MIN_KERNEL:
+        return fft_convolve(img, kernel, mode=mode)
+    return ndimage.filters.convolve(img, kernel, mode=mode)
+
+
 def gen_fake_data(list_of_locs, p_rad, hwhm, img_shape):
     """
     Function to generate fake images for testing purposes
@@ -0,0 +1,136 @@
+"""Background threads for overlapping disk I/O with computation.
+
+A tracking job alternates between reading images, identifying and linking
+features, and writing tracks to disk. The classes here let the first and last of
+those run in their own threads, connected to the main thread by bounded queues.
+Most of the I/O work (file reads, PNG decoding, HDF5 compression) releases
+the GIL, so it proceeds while the main thread computes.
+"""
+# Copyright 2013 Nathan C. Keim
+#
+#This program is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 3 of the License, or (at
+#your option) any later version.
+#
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+#General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, see <http://www.gnu.org/licenses>.
+
+import sys, threading, Queue
+
+_POLL_INTERVAL = 0.5 # seconds; how often blocked threads check on each other
+
+class _Done(object):
+    """Marks the end of a queue."""
+    pass
+class _Failed(object):
+    """Carries an exception from a background thread."""
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+class Prefetcher(object):
+    """Iterate over 'source' in a background thread, keeping up to 'depth'
+    items ready for the consumer.
+
+    Exceptions raised by 'source' are re-raised in the consuming thread.
+    """
+    def __init__(self, source, depth=8):
+        self.queue = Queue.Queue(maxsize=depth)
+        self.maxsize = depth
+        self._stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(source,))
+        self.thread.daemon = True
+        self.thread.start()
+    def _run(self, source):
+        try:
+            for item in source:
+                if not self._put(item):
+                    return
+        except Exception:
+            self._put(_Failed(sys.exc_info()))
+        else:
+            self._put(_Done())
+    def _put(self, item):
+        """Put 'item' on the queue. Returns False if the consumer has gone away."""
+        while not self._stopped.is_set():
+            try:
+                self.queue.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    def __iter__(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if isinstance(item, _Done):
+                    return
+                elif isinstance(item, _Failed):
+                    raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+                yield item
+        finally:
+            self.stop()
+    def stop(self):
+        """Abandon the source. The background thread exits soon after."""
+        self._stopped.set()
+    def qsize(self):
+        """Number of items waiting to be consumed."""
+        return self.queue.qsize()
+
+class BackgroundWriter(object):
+    """Call 'func' with the arguments of each call to put(), in a background thread.
+
+    Up to 'depth' items are queued; beyond that, put() blocks. An exception
+    raised by 'func' stops the thread and is re-raised by the next call to
+    put() or close().
+    """
+    def __init__(self, func, depth=8):
+        self.func = func
+        self.queue = Queue.Queue(maxsize=depth)
+        self.maxsize = depth
+        self._failure = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if isinstance(item, _Done):
+                return
+            try:
+                self.func(*item)
+            except Exception:
+                self._failure = _Failed(sys.exc_info())
+                return
+    def _check(self):
+        if self._failure is not None:
+            exc_info = self._failure.exc_info
+            raise exc_info[0], exc_info[1], exc_info[2]
+    def _put(self, item):
+        while self.thread.is_alive():
+            try:
+                self.queue.put(item, timeout=_POLL_INTERVAL)
+                return
+            except Queue.Full:
+                pass
+    def put(self, *args):
+        """Queue 'args' for writing."""
+        self._check()
+        self._put(args)
+        self._check()
+    def join(self):
+        """Wait for all queued items to be written. Does not raise errors."""
+        self._put(_Done())
+        self.thread.join()
+    def close(self):
+        """Wait for all queued items to be written, and re-raise any error."""
+        self.join()
+        self._check()
+    def qsize(self):
+        """Number of items waiting to be written."""
+        return self.queue.qsize()
@@ -14,10 +14,10 @@
 #You should have received a copy of the GNU General Public License
 #along with this program; if not, see <http://www.gnu.org/licenses>.
 
-import os, json, time, datetime
+import os, json, time, datetime, contextlib
 import pandas
 from util import DirBase, readSingleCfg
-from .statusboard import format_td
+from .statusboard import format_td, StatusDB
 
 def _runtracking(mov, cfg, progress=False):
     """Decide parameters for tracking and then run track2disk().
@@ -28,7 +28,12 @@ def _runtracking(mov, cfg, progress=False):
     To be run in a parallel worker. Expects to find the track2disk() function in
     runtrackpy.track
     """
-    from runtrackpy.track import track2disk, get_window
+    from runtrackpy.track import track2disk, track2disk_chunked, get_window
+    from runtrackpy.framesources import open_stack, is_stack_filename
+    if cfg.get('chunks'):
+        for option in ('resume', 'timing'):
+            if cfg.get(option):
+                raise ValueError('"%s" cannot be used with "chunks".' % option)
     with mov():
         # Read parameters
         if cfg.get('quickparams') is not None:
@@ -38,6 +43,8 @@ def _runtracking(mov, cfg, progress=False):
         # Find image files
         if cfg.get('frames_pattern') is not None:
             framefiles = mov.p.glob(cfg['frames_pattern'])
+            if len(framefiles) == 1 and is_stack_filename(framefiles[0]):
+                framefiles = open_stack(framefiles[0], params)
         else:
             try:
                 framefiles = mov.framesRecord().filename.tolist()
@@ -52,18 +59,102 @@ def _runtracking(mov, cfg, progress=False):
             if lastframe == -1: 
                 lastframe = len(framefiles)
             selectframes = range(window['firstframe'], lastframe + 1)
-        track2disk(framefiles, 
-                cfg['tracksfilename'], params, selectframes=selectframes,
-                statusfile=cfg['statusfilename'], progress=progress)
+        if cfg.get('chunks'):
+            track2disk_chunked(framefiles, cfg['tracksfilename'], params,
+                    selectframes=selectframes, chunks=cfg['chunks'],
+                    workers=cfg.get('chunk_workers'),
+                    statusfile=cfg['statusfilename'], progress=progress,
+                    storage=cfg.get('storage'))
+        else:
+            track2disk(framefiles, 
+                    cfg['tracksfilename'], params, selectframes=selectframes,
+                    statusfile=cfg['statusfilename'], progress=progress,
+                    storage=cfg.get('storage'), resume=cfg.get('resume', False),
+                    timing=cfg.get('timing', False))
     return mov.p
+
+# Running jobs without IPython
+_THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+        'NUMEXPR_NUM_THREADS', 'NUMBA_NUM_THREADS']
+def _limit_threads(nthreads):
+    """Limit the threads used by numerical libraries in this process.
+
+    Environment variables cover libraries that have not been loaded yet. For
+    those that have, 'threadpoolctl' and numba's set_num_threads() are used
+    where available."""
+    for var in _THREAD_ENV_VARS:
+        os.environ[var] = str(nthreads)
+    try:
+        import threadpoolctl
+    except ImportError:
+        pass
+    else:
+        threadpoolctl.threadpool_limits(nthreads)
+    try:
+        import numba
+        numba.set_num_threads(nthreads)
+    except (ImportError, AttributeError, ValueError):
+        pass
+def _run_job(nthreads, func, args, kw):
+    """Run 'func' in a worker process of a LocalView."""
+    if nthreads:
+        _limit_threads(nthreads)
+    return func(*args, **kw)
+class LocalJob(object):
+    """A job submitted to a LocalView. Works like an IPython AsyncResult."""
+    def __init__(self, future):
+        self.future = future
+    def ready(self):
+        return self.future.done()
+    def get(self, timeout=None):
+        """Wait for and return the result, or re-raise the job's exception."""
+        return self.future.result(timeout)
+    def abort(self):
+        """Cancel the job if it has not started. Returns whether it was cancelled.
+        Jobs that are already running cannot be aborted."""
+        return self.future.cancel()
+    def display_outputs(self):
+        """Describe the outcome of a finished job, or return None."""
+        if not self.future.done() or self.future.cancelled():
+            return None
+        exc = self.future.exception()
+        if exc is not None:
+            return 'Error: %r' % exc
+        return 'Result: %r' % (self.future.result(),)
+class LocalView(object):
+    """Stands in for an IPython load-balanced view, running jobs in a pool of 
+    'workers' processes on this computer (default: one per CPU), using 
+    concurrent.futures (the "futures" package in Python 2).
+
+    If 'threads_per_worker' is given, numerical libraries (BLAS, numba, etc.) in
+    each worker are limited to that many threads, so that jobs do not compete 
+    for CPUs.
+    """
+    def __init__(self, workers=None, threads_per_worker=None):
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        self.workers = int(workers or multiprocessing.cpu_count())
+        self.threads_per_worker = threads_per_worker
+        self.executor = ProcessPoolExecutor(self.workers)
+    def apply(self, func, *args, **kw):
+        """Submit func(*args, **kw). Returns a LocalJob."""
+        return LocalJob(self.executor.submit(_run_job, self.threads_per_worker,
+            func, args, kw))
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
 class TrackingRunner(object):
     """User interface for parallel tracking in IPython. Basic idea: run a specified 
     function (default _runtracking()) in a parallel worker for each movie directory 
     given, and monitor status of the tracking jobs.
 
     'movie_dirs' is a list of directory names.
-    'load_balanced_view' is an IPython parallel processing view. If not specified, you
-        can use only the run() method below. 
+    'load_balanced_view' is an IPython parallel processing view, or a LocalView.
+        If not specified, and 'workers' is not given, you can use only the 
+        run() method below. 
+    'workers' starts a LocalView with that many processes, for running jobs
+        on this computer without IPython. 'threads_per_worker' optionally limits
+        the threads used by numerical libraries in each; see LocalView.
     'tracksfilename' is the destination tracks file in each movie directory. 
         By convention it has the extension ".h5". Any needed subdirectories
         will be created.
@@ -72,9 +163,22 @@ class TrackingRunner(object):
         the file "trackpy.ini" in each movie directory. See the "track" module 
         for details of what parameters are required.
     'frames_pattern' uses glob-style wildcards to specify image files, e.g.
-        "Frame_*.png"
+        "Frame_*.png". If it matches a single stack file (e.g. "movie.tif" or
+        "movie.npy"), frames are read from that file; see framesources.open_stack().
     'paramsfilename' is the name of the .ini file in each directory where parameters
         are stored (ignored if 'quickparams' was given).
+    'storage' is a dict of options for writing the tracks file; see the "track" module.
+    If 'timing', each job times the stages of tracking, so that status_board()
+        can show where the time goes.
+    'chunks' splits each movie into that many ranges of frames, which are tracked
+        in parallel, in 'chunk_workers' processes, and stitched together; see
+        track.track2disk_chunked(). This is for a few long movies, and is best
+        used with run(), since the processes of a cluster or LocalView may not
+        be allowed to start their own. Chunked jobs cannot be timed or resumed.
+    'status_db' optionally names an SQLite database in which all jobs record
+        their status, instead of a JSON file in each movie directory. This is 
+        much faster for many movies, and keeps a history of throughput; see
+        statusboard.StatusDB and throughput_history().
     'statusfilename' and 'tracking_function' are not user-serviceable.
     
     An instance can be constructed with 'from_objects()' if you would like to pass 
@@ -87,7 +191,9 @@ class TrackingRunner(object):
             quickparams=None, frames_pattern=None,
             paramsfilename='trackpy.ini',
             statusfilename='trackingstatus.json', 
-            tracking_function=_runtracking):
+            tracking_function=_runtracking, storage=None, timing=False,
+            workers=None, threads_per_worker=None, chunks=None, chunk_workers=None,
+            status_db=None):
         """If quickparams == None, use 'trackpy.ini' in each directory.
         If frames_pattern == None, tries to obtain the file list from
             the author's own custom movie class.
@@ -99,8 +205,17 @@ class TrackingRunner(object):
         self.frames_pattern = frames_pattern
         self.quickparams = quickparams
         self.tracking_function = tracking_function
+        self.storage = storage
+        self.timing = timing
+        self.chunks = chunks
+        self.chunk_workers = chunk_workers
+        self.status_db = os.path.abspath(status_db) if status_db is not None else None
+        if chunks and timing:
+            raise ValueError('"timing" cannot be used with "chunks".')
         self.parallel_results = []
         self.parallel_results_mostrecent = {}
+        if load_balanced_view is None and workers:
+            load_balanced_view = LocalView(workers, threads_per_worker)
         self.load_balanced_view = load_balanced_view
     @classmethod
     def from_objects(cls, objlist, *args, **kw):
@@ -108,56 +223,71 @@ class TrackingRunner(object):
         r = cls([], *args, **kw)
         r.movies = objlist
         return r
-    def _prepare_run_config(self, mov):
+    def _prepare_run_config(self, mov, resume=False):
         cfg = dict(quickparams=self.quickparams, tracksfilename=self.tracksfilename,
-                statusfilename=self.statusfilename, paramsfilename=self.paramsfilename,
-                frames_pattern=self.frames_pattern)
+                statusfilename=self.status_db or self.statusfilename, 
+                paramsfilename=self.paramsfilename,
+                frames_pattern=self.frames_pattern, storage=self.storage,
+                resume=resume, timing=self.timing, chunks=self.chunks,
+                chunk_workers=self.chunk_workers)
         return mov, cfg
-    def submit(self, movie_index, clear_output=False):
-        """Submit (or resubmit) a job to the load-balanced view.
+    def submit(self, movie_index, clear_output=False, resume=False):
+        """Submit (or resubmit) a job to the load-balanced view (or LocalView).
         'movie_index' references what you see from status_board().
 
         If 'clear_output', delete the output and status files.
+        If 'resume', continue from the last checkpoint in an existing output file.
         """
         mov = self.movies[movie_index]
         if clear_output:
             outputfile = mov.p / self.tracksfilename
             if outputfile.exists():
                 outputfile.unlink()
-            statusfile = mov.p / self.statusfilename
-            if statusfile.exists():
-                statusfile.unlink()
-        pres = self.load_balanced_view.apply(self.tracking_function, *self._prepare_run_config(mov))
+            self._clear_status(mov)
+        pres = self.load_balanced_view.apply(self.tracking_function, 
+                *self._prepare_run_config(mov, resume=resume))
         self.parallel_results.append((movie_index, pres))
         self.parallel_results_mostrecent[movie_index] = pres
         return pres
-    def start(self, clear_output=False):
-        """Start jobs for all movies on an IPython load-balanced cluster view.
+    def _clear_status(self, mov):
+        if self.status_db is not None:
+            with contextlib.closing(StatusDB(self.status_db)) as db:
+                db.clear(mov.p)
+        else:
+            statusfile = mov.p / self.statusfilename
+            if statusfile.exists():
+                statusfile.unlink()
+    def start(self, clear_output=False, resume=False):
+        """Start jobs for all movies on an IPython load-balanced cluster view
+        (or LocalView).
         If 'clear_output', delete the output and status files.
+        If 'resume', continue interrupted jobs from their last checkpoints.
         """
         for i in range(len(self.movies)):
-            self.submit(i, clear_output=clear_output)
+            self.submit(i, clear_output=clear_output, resume=resume)
     def abort(self, movie_index):
         """Cancel job. 'movie_index' references what you see from status_board().
         """
         return self.parallel_results_mostrecent[movie_index].abort()
-    def run(self, movie_index, clear_output=False, progress=False):
+    def run(self, movie_index, clear_output=False, progress=False, resume=False):
         """Run job in the current process (not parallel).
         
-        If 'progress', display status updates."""
+        If 'progress', display status updates.
+        If 'resume', continue from the last checkpoint in an existing output file."""
         mov = self.movies[movie_index]
         with mov():
             if clear_output:
                 outputfile = mov.p / self.tracksfilename
                 if outputfile.exists():
                     outputfile.unlink()
-                statusfile = mov.p / self.statusfilename
-                if statusfile.exists():
-                    statusfile.unlink()
-            return self.tracking_function(*self._prepare_run_config(mov),
+                self._clear_status(mov)
+            return self.tracking_function(*self._prepare_run_config(mov, resume=resume),
                     progress=progress)
     def display_outputs(self):
-        from IPython.parallel import TimeoutError
+        try:
+            from IPython.parallel import TimeoutError
+        except ImportError: # Local jobs only
+            TimeoutError = ()
         for i in range(len(self.movies)):
             print 'Movie index {}'.format(i)
             try:
@@ -167,7 +297,22 @@ class TrackingRunner(object):
     def read_statuses(self):
         """Returns DataFrame of all status info"""
         info = []
+        if self.status_db is not None:
+            with contextlib.closing(StatusDB(self.status_db)) as db:
+                dbstatuses = db.read()
         for mov in self.movies:
+            if self.status_db is not None:
+                # One query for all jobs, instead of a status file per movie.
+                # Jobs record the real path of their directory; see StatusDB.
+                sfinfo = dbstatuses.get(os.path.realpath(str(mov.p)))
+                if sfinfo is None:
+                    sfinfo = {'working_dir': str(mov.p), 'status': 'waiting'}
+                    since_update = None
+                else:
+                    since_update = datetime.timedelta(0, sfinfo['seconds_since_update'])
+                sfinfo['output'] = 'yes' if (mov.p / self.tracksfilename).exists() else ''
+                info.append(self._check_status(sfinfo, since_update))
+                continue
             sfn = mov.p / self.statusfilename
             try:
                 sf = open(sfn, 'r')
@@ -182,27 +327,42 @@ class TrackingRunner(object):
                 sfinfo['output'] = 'yes'
             else:
                 sfinfo['output'] = ''
-            if sfinfo['status'] != 'done':
-                if since_update is not None:
-                    # heartbeat timeout is 10x frame interval, or 5 minutes, 
-                    # whichever is greater.
-                    heartbeat_timeout = max(float(sfinfo.get('seconds_per_frame', 0)) * 10, 
-                            300)
-                    if since_update.total_seconds() > heartbeat_timeout:
-                        sfinfo['status'] = 'DEAD'
-                else:
-                    # If there is a tracks file but no status file, act confused.
-                    if sfinfo['output']:
-                        sfinfo['status'] = '??'
-            else:
-                # If there's no tracks file, assume the status is from an old run
-                if not sfinfo['output']:
-                    sfinfo['status'] = 'waiting'
-            info.append(sfinfo)
+            info.append(self._check_status(sfinfo, since_update))
         return pandas.DataFrame(info)
-    def status_board(self):
+    def _check_status(self, sfinfo, since_update):
+        """Correct the reported status of a job that has died or is stale."""
+        if sfinfo['status'] != 'done':
+            if since_update is not None:
+                # heartbeat timeout is 10x frame interval, or 5 minutes, 
+                # whichever is greater.
+                heartbeat_timeout = max(float(sfinfo.get('seconds_per_frame', 0)) * 10, 
+                        300)
+                if since_update.total_seconds() > heartbeat_timeout:
+                    sfinfo['status'] = 'DEAD'
+            else:
+                # If there is a tracks file but no status file, act confused.
+                if sfinfo['output']:
+                    sfinfo['status'] = '??'
+        else:
+            # If there's no tracks file, assume the status is from an old run
+            if not sfinfo['output']:
+                sfinfo['status'] = 'waiting'
+        return sfinfo
+    def throughput_history(self, movie_index=None):
+        """DataFrame of frames/sec over time, for one movie or all.
+        Requires 'status_db'."""
+        if self.status_db is None:
+            raise ValueError('Throughput history requires a status database ("status_db").')
+        working_dir = None if movie_index is None else self.movies[movie_index].p
+        with contextlib.closing(StatusDB(self.status_db)) as db:
+            return db.history(working_dir)
+    def status_board(self, stages=False):
         """Presents status info for a list of filenames.
 
+        If 'stages', add the stage of tracking that has taken the most time in
+        each job, and the rolling mean time of each stage in ms (for jobs run
+        with 'timing'; see the constructor).
+
         Returns a DataFrame, which should display nicely.
         """
         df = self.read_statuses().rename(columns={'seconds_per_frame': 'secs_per_frame'})
@@ -210,6 +370,15 @@ class TrackingRunner(object):
                 'totalframes', 'mr_frame', 'secs_per_frame', 
                 'elapsed_time', 'time_left', 'status', 'output', 
                 'since_update']
+        if stages:
+            columns.append('dominant_stage')
+            if 'stages' in df:
+                stagestats = [st if isinstance(st, dict) else {} for st in df['stages']]
+                names = sorted(set(name for st in stagestats for name in st))
+                for name in names:
+                    df[name + '_ms'] = [st[name]['mean_ms'] if name in st else ''
+                            for st in stagestats]
+                    columns.append(name + '_ms')
         for cn in columns:
             if cn not in df:
                 df[cn] = ''
@@ -14,7 +14,7 @@
 #You should have received a copy of the GNU General Public License
 #along with this program; if not, see <http://www.gnu.org/licenses>.
 
-import os, json, time, datetime
+import os, json, time, datetime, threading, collections
 import numpy as np
 import pandas
 
@@ -66,6 +66,109 @@ class StatusFile(object):
             os.unlink(self.filename) # Windows doesn't allow overwriting existing file
         os.rename(tmpname, self.filename)
 
+def open_status(statusfile, persistent_info):
+    """StatusFile or StatusDBFile for 'statusfile', according to its extension.
+
+    Names ending in ".sqlite" or ".db" are SQLite status databases.
+    """
+    if os.path.splitext(statusfile)[1].lower() in ('.sqlite', '.db'):
+        return StatusDBFile(statusfile, persistent_info)
+    return StatusFile(statusfile, persistent_info)
+
+# Status of many jobs in a single SQLite database
+class StatusDB(object):
+    """SQLite database holding the status of many tracking jobs.
+
+    There is one row per job, keyed by its working directory (with symbolic
+    links resolved, so that a directory has one key), with the same 
+    information as a StatusFile, and a table of throughput history. The 
+    database uses write-ahead logging, so that readers and writers do not 
+    block each other. This requires that all processes using the database be 
+    on one computer, or that the filesystem support shared memory-mapping 
+    (many network filesystems do not).
+    """
+    def __init__(self, filename, timeout=60):
+        import sqlite3
+        self.filename = os.path.abspath(filename)
+        self.conn = sqlite3.connect(self.filename, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS jobs (working_dir TEXT PRIMARY KEY, '
+                    'status TEXT, updated REAL, info TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS history (working_dir TEXT, '
+                    'time REAL, mr_frame INTEGER, frames_per_sec REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS history_dir '
+                    'ON history (working_dir, time)')
+    def write(self, working_dir, info):
+        """Replace the status of the job in 'working_dir' with the dict 'info',
+        and add to its throughput history."""
+        now = time.time()
+        spf = info.get('seconds_per_frame')
+        working_dir = os.path.realpath(working_dir)
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)',
+                    (working_dir, info.get('status'), now, json.dumps(info)))
+            if info.get('mr_frame') is not None and spf > 0:
+                self.conn.execute('INSERT INTO history VALUES (?, ?, ?, ?)',
+                        (working_dir, now, info['mr_frame'], 1. / spf))
+    def read(self):
+        """Dict of status dicts for all jobs, keyed by working directory.
+
+        Each has 'since_update' (formatted) and 'seconds_since_update' added."""
+        now = time.time()
+        statuses = {}
+        for working_dir, updated, info in self.conn.execute(
+                'SELECT working_dir, updated, info FROM jobs'):
+            info = json.loads(info)
+            info['seconds_since_update'] = now - updated
+            info['since_update'] = format_td(datetime.timedelta(0, now - updated))
+            statuses[working_dir] = info
+        return statuses
+    def history(self, working_dir=None):
+        """DataFrame of throughput over time, for one job or all."""
+        query = 'SELECT working_dir, time, mr_frame, frames_per_sec FROM history'
+        args = ()
+        if working_dir is not None:
+            query += ' WHERE working_dir = ?'
+            args = (os.path.realpath(working_dir),)
+        rows = self.conn.execute(query + ' ORDER BY working_dir, time', args).fetchall()
+        return pandas.DataFrame(rows, 
+                columns=['working_dir', 'time', 'mr_frame', 'frames_per_sec'])
+    def clear(self, working_dir):
+        """Forget the status and history of a job."""
+        working_dir = os.path.realpath(working_dir)
+        with self.conn:
+            self.conn.execute('DELETE FROM jobs WHERE working_dir = ?', (working_dir,))
+            self.conn.execute('DELETE FROM history WHERE working_dir = ?', (working_dir,))
+    def close(self):
+        self.conn.close()
+class StatusDBFile(object):
+    """Works like StatusFile, but writes to a StatusDB, at most once every
+    'min_interval' seconds (except for changes to "status").
+
+    The job is identified by 'working_dir' in 'persistent_info', or the 
+    current directory.
+    """
+    def __init__(self, filename, persistent_info, min_interval=5.):
+        self.db = StatusDB(filename)
+        self.persistent_info = persistent_info.copy()
+        self.working_dir = os.path.realpath(
+                self.persistent_info.get('working_dir', os.getcwd()))
+        self.min_interval = min_interval
+        self._last_write = 0
+        self._last_status = None
+    def update(self, newinfo):
+        """Record 'newinfo', including persistent information, unless the last
+        write was too recent."""
+        status = newinfo.get('status')
+        now = time.time()
+        if status == self._last_status and now - self._last_write < self.min_interval:
+            return
+        info = self.persistent_info.copy()
+        info.update(newinfo)
+        self.db.write(self.working_dir, info)
+        self._last_write, self._last_status = now, status
+
 class Stopwatch(object):
     """Keeps track of execution time"""
     def __init__(self):
@@ -102,6 +205,118 @@ class Stopwatch(object):
         return datetime.timedelta(0, 
                 self.mean_lap_time() * (total_laps - len(self.laptimes)))
 
+# Timing of the stages of tracking
+class StageTimes(object):
+    """Collects the time spent in each stage of a computation.
+
+    Keeps the most recent 'window' samples of each stage, for rolling means
+    and percentiles, and the total time and count since the start.
+    Samples can be added from any thread.
+
+    Stages timed in other processes (see extend()), or in threads that work 
+    alongside the main one (see mark_concurrent_thread()), run concurrently 
+    with each other and with the main thread, so their totals are not 
+    comparable to the elapsed time there. They are marked with 'remote' in 
+    summary(), and left out of dominant().
+    """
+    def __init__(self, window=100):
+        self.window = window
+        self.samples = collections.defaultdict(
+                lambda: collections.deque(maxlen=self.window))
+        self.totals = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+        self.remote = set() # Stages timed in other processes or threads
+        self._lock = threading.Lock()
+    def add(self, stage, seconds, remote=False):
+        """Add a sample. If 'remote', it was timed concurrently with the main
+        thread of this process."""
+        with self._lock:
+            self.samples[stage].append(seconds)
+            self.totals[stage] += seconds
+            self.counts[stage] += 1
+            if remote:
+                self.remote.add(stage)
+    def extend(self, samples, remote=False):
+        """Add a list of (stage, seconds). If 'remote', they were timed in 
+        another process."""
+        for stage, seconds in samples:
+            self.add(stage, seconds, remote)
+    def dominant(self):
+        """Name of the stage, timed in this process, with the greatest total
+        time, or None."""
+        with self._lock:
+            local = [k for k in self.totals if k not in self.remote]
+            if not local:
+                return None
+            return max(local, key=self.totals.get)
+    def summary(self):
+        """Dict of statistics for each stage, in milliseconds."""
+        with self._lock:
+            stages = dict((k, np.array(v)) for k, v in self.samples.items() if len(v))
+            totals, counts = dict(self.totals), dict(self.counts)
+            remote = set(self.remote)
+        summ = {}
+        for stage, samples in stages.items():
+            p50, p90, p99 = np.percentile(samples, [50, 90, 99]) * 1e3
+            summ[stage] = dict(mean_ms=round(samples.mean() * 1e3, 3),
+                    p50_ms=round(p50, 3), p90_ms=round(p90, 3), p99_ms=round(p99, 3),
+                    count=counts[stage], total_seconds=round(totals[stage], 3),
+                    remote=stage in remote)
+        return summ
+class _Laps(object):
+    """Times consecutive stages in one thread, for a StageTimes."""
+    def __init__(self, times, remote=False):
+        self.times = times
+        self.remote = remote
+        self.t0 = time.time()
+    def start(self):
+        """Begin timing the next stage now."""
+        self.t0 = time.time()
+    def mark(self, stage):
+        """Record the time since the last mark (or start()) as 'stage'."""
+        t = time.time()
+        self.times.add(stage, t - self.t0, self.remote)
+        self.t0 = t
+class _NullLaps(object):
+    """Stands in for _Laps when timing is disabled."""
+    def start(self):
+        pass
+    def mark(self, stage):
+        pass
+_null_laps = _NullLaps()
+_stage_times = None
+_thread_laps = threading.local()
+def enable_stage_timing(times):
+    """Record stage times in this process to the StageTimes 'times'.
+    None disables timing."""
+    global _stage_times
+    _stage_times = times
+def current_stage_times():
+    """The StageTimes enabled in this process, or None."""
+    return _stage_times
+def stage_laps():
+    """Stopwatch for the stages of work in the current thread.
+
+    Call start() at the beginning of a sequence of stages, then mark(stage) at
+    the end of each one. When timing is disabled (see enable_stage_timing()),
+    these do nothing.
+    """
+    if _stage_times is None:
+        return _null_laps
+    laps = getattr(_thread_laps, 'laps', None)
+    if laps is None or laps.times is not _stage_times:
+        laps = _thread_laps.laps = _Laps(_stage_times,
+                getattr(_thread_laps, 'concurrent', False))
+    return laps
+def mark_concurrent_thread():
+    """Record stages timed in the current thread as 'remote' (see StageTimes), 
+    because they overlap with the work of the thread that waits for them, as
+    in a thread pool or a pipeline."""
+    _thread_laps.concurrent = True
+    laps = getattr(_thread_laps, 'laps', None)
+    if laps is not None:
+        laps.remote = True
+
 def format_td(timedelt):
     """Format a timedelta object as NNhNNmNNs"""
     s = int(round(timedelt.total_seconds()))
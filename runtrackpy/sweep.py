@@ -0,0 +1,175 @@
+"""Preview feature identification over a grid of parameters.
+
+sweep() applies the basic identification procedure (track.identify_frame_basic())
+to a few sample frames, for every combination of parameters in a grid, and
+summarizes the results in a DataFrame. Each stage of identification is cached,
+so that e.g. varying only 'threshold' does not repeat band-pass filtering:
+
+    Stage                  Depends on
+    normalized image       'maxgray', 'bright', 'float32'
+    band-passed image      + 'bplow', 'bphigh'
+    local maxima           + 'featsize', 'threshold'
+    centroids              (same as local maxima)
+    cuts and merging       + 'maxrg', 'merge_cutoff', 'merge_method' (not cached)
+
+Example:
+    results = sweep(sample_files, dict(featsize=[3, 4, 5], threshold=[0.05, 0.1, 0.2],
+                                       bphigh=[0.7, 1]), base_params=params)
+    results.groupby(['featsize', 'threshold']).n_features.mean()
+"""
+# Copyright 2013 Nathan C. Keim
+#
+#This program is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 3 of the License, or (at
+#your option) any later version.
+#
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+#General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program; if not, see <http://www.gnu.org/licenses>.
+
+import itertools
+import numpy as np
+import pandas
+
+from . import track, identification
+
+def param_grid(grid):
+    """List of parameter dicts for every combination of values in 'grid', a
+    dict of lists. A list of dicts is returned unchanged."""
+    if not isinstance(grid, dict):
+        return [dict(p) for p in grid]
+    names = sorted(grid)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[grid[n] for n in names])]
+
+class StageCache(object):
+    """Intermediate results of identifying features in one image, for
+    parameter sets that share stages. See module docs."""
+    def __init__(self, image):
+        self.image = image # Image array, or filename to read with track.imread()
+        self.normalized = {}
+        self.bandpassed = {}
+        self.features = {} # Centroids of local maxima, before cuts
+        self.computed = dict(normalized=0, bandpassed=0, features=0)
+    def _get(self, stage, key, func):
+        cache = getattr(self, stage)
+        if key not in cache:
+            cache[key] = func()
+            self.computed[stage] += 1
+        return cache[key]
+    def normalized_image(self, params):
+        key = (params.get('maxgray', 0), bool(params.get('bright', 0)),
+                bool(params.get('float32', 0)))
+        def compute():
+            if isinstance(self.image, np.ndarray):
+                im = np.asarray(self.image, dtype=np.float32 if key[2] else float)
+            else:
+                im = track.imread(self.image, params)
+            return 1 - im if key[1] else im
+        return key, self._get('normalized', key, compute)
+    def bandpassed_image(self, params):
+        nkey, im = self.normalized_image(params)
+        featsize = params.get('featsize', 3)
+        bplow, bphigh = params.get('bplow', featsize), params.get('bphigh', 0.7)
+        key = nkey + (bplow, bphigh)
+        if key[2]: # float32
+            im = np.asarray(im, dtype=np.float32)
+        # No workspace: results must not share buffers.
+        return key, self._get('bandpassed', key,
+                lambda: identification.band_pass(im, bplow, bphigh))
+    def raw_features(self, params):
+        """Features before cuts and merging."""
+        bkey, imbp = self.bandpassed_image(params)
+        featsize = params.get('featsize', 3)
+        threshold = params.get('threshold', 1e-15)
+        key = bkey + (featsize, threshold)
+        return self._get('features', key, lambda: track._bandpassed_features(imbp,
+            dict(featsize=featsize, threshold=threshold,
+                lm_engine=params.get('lm_engine', 'auto'))))
+    def identify(self, params, window=None):
+        """Features DataFrame, as from track.identify_frame_basic()."""
+        return track.postprocess_features(self.raw_features(params), params, window=window)
+
+def _stage_order(params):
+    """Sort key that groups parameter sets sharing cached stages."""
+    featsize = params.get('featsize', 3)
+    return (params.get('maxgray', 0), params.get('bright', 0), params.get('float32', 0),
+            params.get('bplow', featsize), params.get('bphigh', 0.7),
+            featsize, params.get('threshold', 1e-15))
+
+def summarize_features(ftr):
+    """Dict of statistics of a features DataFrame."""
+    stats = dict(n_features=len(ftr))
+    for col in ('intensity', 'rg2'):
+        vals = ftr[col].values if len(ftr) else np.array([np.nan])
+        stats[col + '_mean'] = np.mean(vals)
+        stats[col + '_median'] = np.median(vals)
+        stats[col + '_std'] = np.std(vals)
+    # Fractional parts of positions should be uniformly distributed, with a
+    # standard deviation of 0.289. Much less indicates "pixel locking".
+    if len(ftr):
+        stats['subpixel_std'] = np.std(np.concatenate(
+            [np.mod(ftr.x.values, 1), np.mod(ftr.y.values, 1)]))
+    else:
+        stats['subpixel_std'] = np.nan
+    return stats
+
+def _sweep_image(job):
+    """Identify one image with a list of parameter sets, sharing stages among
+    them. Run in a worker.
+    
+    Returns a list of rows for sweep()."""
+    imindex, image, paramsets, window = job
+    cache = StageCache(image)
+    rows = []
+    for i, params in paramsets:
+        row = dict(params_index=i, image=imindex)
+        row.update(summarize_features(cache.identify(params, window)))
+        rows.append(row)
+    return rows
+
+def sweep(images, grid, base_params=None, window=None, workers=None):
+    """Identify features in sample 'images' with each parameter set in 'grid'.
+
+    'images' is a list of image arrays (normalized, as from track.imread()) or
+    image filenames. 'grid' is a dict of lists of values, whose combinations
+    are tried (see param_grid()), or a list of dicts. Each overrides
+    'base_params'. 'window' is as for identify_frame().
+
+    Each image is read and normalized once, and each parameter set reuses the
+    stages it shares with the one before (see StageCache). If 'workers' is 
+    greater than 1, the images are divided among that many processes.
+
+    Returns a DataFrame with one row per parameter set and image: the values of
+    the parameters in 'grid', 'params_index' (the index in param_grid(grid)),
+    'image' (the index in 'images'), and statistics from summarize_features().
+    """
+    if base_params is None: base_params = {}
+    if window == 'file':
+        window = track.get_window()
+    grid = param_grid(grid)
+    paramsets = sorted([(i, track.compile_params(dict(base_params, **p)))
+        for i, p in enumerate(grid)], key=lambda ip: _stage_order(ip[1]))
+    jobs = [(imindex, image, paramsets, window) for imindex, image in enumerate(images)]
+    if workers is not None and int(workers) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(int(workers))
+        try:
+            results = pool.map(_sweep_image, jobs, chunksize=1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = map(_sweep_image, jobs)
+    rows = [row for jobrows in results for row in jobrows]
+    df = pandas.DataFrame(rows)
+    gridvalues = pandas.DataFrame(grid)
+    df = gridvalues.join(df.set_index('params_index'), how='right')
+    df.index.name = 'params_index'
+    return df.reset_index().sort(['params_index', 'image']).reset_index(drop=True)
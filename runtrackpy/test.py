@@ -1,11 +1,12 @@
-import os.path, tempfile, shutil, itertools
+import os.path, tempfile, shutil, itertools, json
 from glob import glob
 import random
 import numpy as np
 import numpy.random as npr
 import scipy.misc
+import pandas, tables
 
-from . import track
+from . import track, framesources, identification, run, featurestore
 from pantracks import BigTracks, bigtracks
 
 def fake_image(motion_seed=1, pos_seed=314, size=200, maxdisp=3):
@@ -59,6 +60,240 @@ def test_identification():
     ftr = track.identify_frame((img.max() - img) / img.max(), params)
     assert np.max(np.abs(ftr.y - np.array(sorted(y)))) < 0.1
 
+def test_identification_plan():
+    x, y, img = fake_image(1, maxdisp=3)
+    im = (img.max() - img) / img.max()
+    # As read from "trackpy.ini"
+    plan = track.IdentificationPlan(dict(featsize='4', bphigh='1', threshold='0.3'))
+    assert plan.params['featsize'] == 4
+    ftr = plan.identify(im)
+    assert np.allclose(ftr.x.values, track.identify_frame(im, 
+        dict(featsize=4, bphigh=1, threshold=0.3)).x.values)
+
+def test_identification_tiled():
+    x, y, img = fake_image(1, maxdisp=3)
+    # Brightness varies across the frame, and the first tile has only noise.
+    img = img * np.linspace(0.4, 1, img.shape[1])
+    npr.seed(2)
+    img[:64, :64] = npr.randn(64, 64) * .1
+    im = (img.max() - img) / img.max()
+    params = dict(featsize=4, bphigh=1, threshold=0.3)
+    ftr = track.identify_frame(im, params).sort('x')
+    for tparams in (dict(params, tilesize=64), dict(params, tilesize=50, tile_workers=3)):
+        ftr_tiled = track.identify_frame(im, tparams).sort('x')
+        assert len(ftr_tiled) == len(ftr)
+        for col in ('x', 'y', 'intensity', 'rg2'):
+            assert np.allclose(ftr_tiled[col].values, ftr[col].values)
+
+def test_identification_cropped():
+    x, y, img = fake_image(1, maxdisp=3)
+    img = img * np.linspace(0.4, 1, img.shape[1]) # Brightness varies
+    im = (img.max() - img) / img.max()
+    params = dict(featsize=4, bphigh=1, threshold=0.3)
+    window = track.interpret_window(dict(xmin=50, xmax=120, ymin=30, ymax=150))
+    ftr = track.identify_frame(im, params)
+    ftr = ftr[(ftr.x > window['xmin']) & (ftr.x < window['xmax']) & 
+            (ftr.y > window['ymin']) & (ftr.y < window['ymax'])].sort('x')
+    assert len(ftr) > 0
+    for ftr_windowed in (track.identify_frame(im, params, window=window),
+            track.identify_frames([im, im], params, window=window)[1],
+            track.identify_frame(im, dict(params, tilesize=50), window=window)):
+        ftr_windowed = ftr_windowed.sort('x')
+        assert len(ftr_windowed) == len(ftr)
+        for col in ('x', 'y', 'intensity', 'rg2'):
+            assert np.allclose(ftr_windowed[col].values, ftr[col].values)
+    # With 'crop_window', intensities are relative to the window instead.
+    cparams = dict(params, crop_window=1)
+    for ftr_cropped in (track.identify_frame(im, cparams, window=window),
+            track.identify_frames([im, im], cparams, window=window)[1]):
+        dist, idx = track.cKDTree(ftr_cropped[['x', 'y']].values).query(
+                ftr[['x', 'y']].values)
+        assert np.allclose(dist, 0, atol=1e-4)
+        ratio = ftr_cropped.intensity.values[idx] / ftr.intensity.values
+        assert ratio[0] > 1
+        assert np.allclose(ratio, ratio[0])
+
+def test_sweep():
+    from . import sweep
+    x, y, img = fake_image(1, maxdisp=3)
+    im = (img.max() - img) / img.max()
+    grid = dict(featsize=[3, 4], threshold=[0.2, 0.3])
+    results = sweep.sweep([im], grid, base_params=dict(bphigh=1))
+    assert len(results) == 4
+    row = results[(results.featsize == 4) & (results.threshold == 0.3)].iloc[0]
+    assert row['n_features'] == len(track.identify_frame(im, 
+        dict(featsize=4, bphigh=1, threshold=0.3)))
+    # Stages are shared
+    cache = sweep.StageCache(im)
+    for params in sweep.param_grid(grid):
+        cache.identify(track.compile_params(dict(params, bphigh=1)))
+    assert cache.computed['normalized'] == 1
+    assert cache.computed['bandpassed'] == 2
+    assert cache.computed['features'] == 4
+    # sweep() reads each image once, for all band-pass parameters.
+    testdir = tempfile.mkdtemp()
+    reads = []
+    imread = track.imread
+    def counting_imread(filename, params=None, **kw):
+        reads.append(filename)
+        return imread(filename, params, **kw)
+    try:
+        filenames = [os.path.join(testdir, 'sweep_%i.png' % i) for i in range(2)]
+        for fn in filenames:
+            scipy.misc.imsave(fn, img)
+        track.imread = counting_imread
+        results = sweep.sweep(filenames, dict(bphigh=[0.7, 1, 1.5], threshold=[0.2, 0.3]),
+                base_params=dict(featsize=4, bright=1))
+    finally:
+        track.imread = imread
+        shutil.rmtree(testdir)
+    assert len(results) == 12
+    assert sorted(reads) == filenames
+
+def test_struct_cache():
+    x, y, img = fake_image(1, maxdisp=3)
+    params = dict(featsize=4, bphigh=1, threshold=0.3)
+    track.identify_frame((img.max() - img) / img.max(), params)
+    misses = identification.struct_cache.misses
+    hits = identification.struct_cache.hits
+    track.identify_frame((img.max() - img) / img.max(), params)
+    assert identification.struct_cache.misses == misses
+    assert identification.struct_cache.hits > hits
+
+def test_struct_cache_threads():
+    from multiprocessing.pool import ThreadPool
+    cache = identification.StructCache(maxsize=4)
+    keys = [('key', i % 10) for i in range(5000)]
+    pool = ThreadPool(8)
+    try:
+        values = pool.map(lambda key: cache.get(key, lambda: key[1]), keys)
+    finally:
+        pool.close()
+        pool.join()
+    assert values == [key[1] for key in keys]
+    info = cache.info()
+    assert info['size'] <= 4
+    assert info['hits'] + info['misses'] == len(keys)
+
+def test_identification_float32():
+    x, y, img = fake_image(1, maxdisp=3)
+    params = dict(featsize=4, bphigh=1, threshold=0.3)
+    im = (img.max() - img) / img.max()
+    ftr = track.identify_frame(im, params)
+    ftr32 = track.identify_frame(im, dict(params, float32=1))
+    assert len(ftr32) == len(ftr)
+    assert np.max(np.abs(ftr32.x.values - ftr.x.values)) < 1e-3
+
+def test_band_pass_stack():
+    ims = np.array([fake_image(i, maxdisp=3)[2] for i in range(3)])
+    direct = identification.band_pass_stack(ims, 4, 1, method='direct')
+    fft = identification.band_pass_stack(ims, 4, 1, method='fft')
+    assert np.allclose(direct[1], identification.band_pass(ims[1], 4, 1))
+    assert np.max(np.abs(direct - fft)) < 1e-6
+
+def test_subpixel_centroid_nd():
+    x, y, img = fake_image(1, maxdisp=3)
+    imbp = identification.band_pass((img.max() - img) / img.max(), 4, 1)
+    lm = identification.local_max_crop(imbp, 
+            identification.find_local_max(imbp, 4, threshold=0.3), 4)
+    pos, m, r2 = identification.subpixel_centroid(imbp, lm, 4, struct_shape='diamond')
+    pos_nd, m_nd, r2_nd = identification.subpixel_centroid_nd(imbp, lm, 4)
+    assert np.allclose(pos_nd, pos, atol=1e-4)
+    assert np.allclose(m_nd, m, rtol=1e-4)
+    assert np.allclose(r2_nd, r2, rtol=1e-4)
+
+def test_local_max_engines():
+    x, y, img = fake_image(1, maxdisp=3)
+    imbp = identification.band_pass((img.max() - img) / img.max(), 4, 1)
+    dense = identification.find_local_max(imbp, 4, threshold=0.3, engine='dense')
+    sparse = identification.find_local_max(imbp, 4, threshold=0.3, engine='sparse')
+    assert dense.shape == sparse.shape
+    assert (dense == sparse).all()
+
+def test_identify_volume():
+    np.random.seed(1)
+    pos = np.array([[20., 40., 30.], [20., 25., 40.], [15., 25., 35.]]) # x, y, z
+    pos += np.random.random(pos.shape) - 0.5
+    img = gen_fake_data(pos[::-1], 5, 2.5, (50, 60, 60))
+    params = dict(identfunc='identify_volume_basic', featsize=4, bphigh=1, threshold=0.3)
+    ftr = track.identify_frame((img.max() - img) / img.max(), params)
+    assert len(ftr) == 3
+    assert np.max(np.abs(np.sort(ftr.z.values) - np.sort(pos[2]))) < 0.2
+
+def test_merge_groups():
+    # A chain of 4 features, each 1 px from the next, plus an isolated one.
+    feats = pandas.DataFrame({'x': [0., 1., 2., 3., 20.], 'y': [5., 5., 5., 5., 5.],
+        'intensity': [1., 1., 1., 3., 1.], 'rg2': [1., 1., 1., 1., 1.]})
+    merged = track.merge_groups(feats, 1.5)
+    assert len(merged) == 2
+    assert np.allclose(merged.x.values, [(0 + 1 + 2 + 9) / 6., 20.])
+    assert np.allclose(merged.intensity.values, [6., 1.])
+    # The legacy method only merges immediate neighbors of the first feature.
+    assert len(track.merge_groups(feats, 1.5, method='legacy')) > 2
+
+def test_shared_frame_source():
+    opened = []
+    class CountingStack(framesources.NpyStack):
+        _shared = True
+        def _open(self):
+            opened.append(self.filename)
+            return framesources.NpyStack._open(self)
+    testdir = tempfile.mkdtemp()
+    try:
+        stackfile = os.path.join(testdir, 'stack.npy')
+        np.save(stackfile, np.arange(24, dtype=np.uint8).reshape((2, 3, 4)))
+        # Copies, as unpickled in a worker process, share one handle.
+        for i in range(3):
+            assert CountingStack(stackfile)[1][0, 0] == 12
+        assert len(opened) == 1
+    finally:
+        shutil.rmtree(testdir)
+
+def test_tracks_writer():
+    testdir = tempfile.mkdtemp()
+    outfile = os.path.join(testdir, 'tracks.h5')
+    # Small frames are flushed by 'flush_frames'; the large one, by 'flush_mb'.
+    sizes = [10, 10, 10, 10, 3000, 10]
+    frames = []
+    for fnum, n in enumerate(sizes, 1):
+        frames.append(pandas.DataFrame(dict(frame=np.ones(n) * fnum, 
+            particle=np.arange(n, dtype=float), x=npr.rand(n) * 100, 
+            y=npr.rand(n) * 100, intensity=npr.rand(n), rg2=npr.rand(n))))
+    writer = track._TracksWriter(outfile, len(sizes),
+            storage=dict(flush_frames=4, flush_mb=0.05, checkpoint_frames=2))
+    try:
+        for fnum, ftr in enumerate(frames[:3], 1):
+            writer.append(fnum, ftr)
+        assert writer.nflushes == 0 and writer.table.nrows == 0
+        writer.append(4, frames[3])
+        assert writer.nflushes == 1 and writer.table.nrows == 40
+        assert writer.table.attrs.checkpoint_nframes == 4
+        writer.append(5, frames[4]) # Larger than the buffer, and than 'flush_mb'
+        assert len(writer._buffer) >= 3000
+        assert writer.nflushes == 2 and writer.table.nrows == 3040
+        assert writer.table.attrs.checkpoint_nframes == 4 # Not yet time
+        writer.append(6, frames[5])
+        assert writer.table.nrows == 3040
+        writer.finish()
+    finally:
+        writer.close()
+    h5 = tables.openFile(outfile, 'r')
+    try:
+        table = h5.root.bigtracks
+        attrs = table.attrs
+        assert attrs.checkpoint_nframes == len(sizes)
+        assert attrs.checkpoint_nrows == sum(sizes)
+        assert attrs.checkpoint_frame == len(sizes)
+        assert attrs.checkpoint_next_particle == 3000
+        stored = table.read()
+    finally:
+        h5.close()
+        shutil.rmtree(testdir)
+    expected = pandas.concat(frames, ignore_index=True)
+    assert len(stored) == sum(sizes)
+    for name in track.TRACKPOINT_COLUMNS:
+        assert np.allclose(stored[name], expected[name].values.astype(np.float32))
+
 class test_pipeline():
     # i.e. track2disk
     def setUp(self):
@@ -67,14 +302,16 @@ class test_pipeline():
         self.extension = 'PNG'
         self.outputfile = os.path.join(self.testdir, 'bttest_tracks.h5')
         self.nframes = 3
+        self.trackopts = {} # Extra arguments to track2disk()
         for framenumber in range(self.nframes):
             x, y, img = fake_image(framenumber)
             self.nparticles = len(x)
             scipy.misc.imsave(os.path.join(self.testdir, 
                 'bttest_%.4i.%s' % (framenumber, self.extension)), img)
+    def frames(self):
+        return glob(os.path.join(self.testdir, '*.' + self.extension))
     def test_tracking(self):
-        imgfiles = glob(os.path.join(self.testdir, '*.' + self.extension))
-        track.track2disk(imgfiles, self.outputfile, self.params)
+        track.track2disk(self.frames(), self.outputfile, self.params, **self.trackopts)
         bt = BigTracks(self.outputfile)
         assert bt.maxframe() == self.nframes
         assert len(bt.get_all()) == self.nframes * self.nparticles
@@ -90,3 +327,317 @@ class test_pipeline_predict(test_pipeline):
         self.params['predict'] = 'nearest'
         self.params['maxdisp'] = 4 * np.sqrt(8) # Prediction is bad for fake Brownian particles!
 
+class test_pipeline_workers(test_pipeline):
+    def setUp(self):
+        test_pipeline.setUp(self)
+        self.trackopts['workers'] = 2
+
+class test_pipeline_threaded(test_pipeline):
+    def setUp(self):
+        test_pipeline.setUp(self)
+        self.trackopts['pipeline'] = True
+        self.trackopts['queue_depth'] = 2
+
+class test_pipeline_stack(test_pipeline):
+    def frames(self):
+        imgfiles = sorted(test_pipeline.frames(self))
+        stackfile = os.path.join(self.testdir, 'bttest_stack.npy')
+        np.save(stackfile, np.array([scipy.misc.imread(f) for f in imgfiles]))
+        return framesources.open_stack(stackfile)
+
+class test_pipeline_timing(test_pipeline):
+    def setUp(self):
+        test_pipeline.setUp(self)
+        self.trackopts['timing'] = True
+        self.trackopts['statusfile'] = os.path.join(self.testdir, 'status.json')
+    def test_tracking(self):
+        test_pipeline.test_tracking(self)
+        status = json.load(open(self.trackopts['statusfile']))
+        for stage in ('read', 'band_pass', 'find_local_max', 'link', 'write'):
+            assert status['stages'][stage]['count'] > 0
+        assert status['dominant_stage'] in status['stages']
+
+class test_pipeline_timing_workers(test_pipeline_timing):
+    def setUp(self):
+        test_pipeline_timing.setUp(self)
+        self.trackopts['workers'] = 2
+    def test_tracking(self):
+        test_pipeline_timing.test_tracking(self)
+        status = json.load(open(self.trackopts['statusfile']))
+        assert status['stages']['wait_identify']['count'] > 0
+        assert status['stages']['band_pass']['remote']
+        assert not status['stages'][status['dominant_stage']]['remote']
+
+class test_pipeline_timing_threaded(test_pipeline_timing):
+    def setUp(self):
+        test_pipeline_timing.setUp(self)
+        self.trackopts['pipeline'] = True
+        self.params.update(tilesize=64, tile_workers=2)
+    def test_tracking(self):
+        test_pipeline_timing.test_tracking(self)
+        status = json.load(open(self.trackopts['statusfile']))
+        for stage in ('wait_read', 'tiles', 'link'):
+            assert not status['stages'][stage]['remote']
+        for stage in ('read', 'band_pass', 'write'):
+            assert status['stages'][stage]['remote']
+        assert not status['stages'][status['dominant_stage']]['remote']
+
+class test_pipeline_chunked(test_pipeline):
+    def setUp(self):
+        test_pipeline.setUp(self)
+        for framenumber in range(self.nframes, 12):
+            x, y, img = fake_image(framenumber)
+            scipy.misc.imsave(os.path.join(self.testdir, 
+                'bttest_%.4i.%s' % (framenumber, self.extension)), img)
+        self.nframes = 12
+    def test_tracking(self):
+        frames = sorted(self.frames())
+        track.track2disk_chunked(frames, self.outputfile, self.params, chunks=3)
+        serialfile = os.path.join(self.testdir, 'serial.h5')
+        track.track2disk(frames, serialfile, self.params)
+        chunked = BigTracks(self.outputfile).get_all().sort(['frame', 'particle'])
+        serial = BigTracks(serialfile).get_all().sort(['frame', 'particle'])
+        assert len(chunked) == self.nframes * self.nparticles
+        assert (chunked.particle.values == serial.particle.values).all()
+        assert np.allclose(chunked.x.values, serial.x.values)
+    def test_unpicklable_predictor(self):
+        params = dict(self.params, predictor=lambda: None)
+        try:
+            track.track2disk_chunked(sorted(self.frames()), self.outputfile, params)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('An unpicklable predictor was accepted.')
+    def test_runner_options(self):
+        runner = run.TrackingRunner([self.testdir], quickparams=self.params,
+                frames_pattern='*.' + self.extension, chunks=3)
+        try:
+            runner.run(0, resume=True)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('"resume" was accepted with "chunks".')
+        assert not os.path.exists(os.path.join(self.testdir, runner.tracksfilename))
+        try:
+            run.TrackingRunner([self.testdir], chunks=3, timing=True)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('"timing" was accepted with "chunks".')
+
+class test_pipeline_feature_store(test_pipeline):
+    def setUp(self):
+        test_pipeline.setUp(self)
+        self.trackopts['feature_store'] = os.path.join(self.testdir, 'features.h5')
+    def test_relink(self):
+        frames = sorted(self.frames())
+        track.track2disk(frames, self.outputfile, self.params, **self.trackopts)
+        os.remove(self.outputfile)
+        # Only linking parameters have changed, so no images are needed.
+        moved = os.path.join(self.testdir, 'moved')
+        os.mkdir(moved)
+        for fn in frames:
+            shutil.move(fn, moved)
+        self.params['memory'] = 1
+        track.track2disk(frames, self.outputfile, self.params, 
+                link_only=True, **self.trackopts)
+        # Compare with tracking from scratch
+        freshfile = os.path.join(self.testdir, 'fresh.h5')
+        track.track2disk([os.path.join(moved, os.path.basename(fn)) for fn in frames],
+                freshfile, self.params)
+        relinked = BigTracks(self.outputfile).get_all().sort(['frame', 'particle'])
+        fresh = BigTracks(freshfile).get_all().sort(['frame', 'particle'])
+        assert len(relinked) == self.nframes * self.nparticles
+        assert (relinked.particle.values == fresh.particle.values).all()
+        assert np.allclose(relinked.x.values, fresh.x.values)
+    def test_frame_window(self):
+        frames = sorted(self.frames())
+        window = dict(xmin=0, xmax=np.inf, ymin=0, ymax=np.inf, 
+                firstframe=1, lastframe=-1)
+        track.track2disk(frames, self.outputfile, self.params, window=window,
+                **self.trackopts)
+        # Changing only the frame range still uses the stored features.
+        window['lastframe'] = 2
+        store = featurestore.FeatureStore(self.trackopts['feature_store'], 
+                self.params, window=window, mode='r')
+        try:
+            assert all(fn in store for fn in frames)
+        finally:
+            store.close()
+        window['xmin'] = 1
+        store = featurestore.FeatureStore(self.trackopts['feature_store'], 
+                self.params, window=window, mode='r')
+        try:
+            assert not any(fn in store for fn in frames)
+        finally:
+            store.close()
+
+class test_pipeline_feature_store_threaded(test_pipeline_feature_store):
+    def setUp(self):
+        test_pipeline_feature_store.setUp(self)
+        self.trackopts['pipeline'] = True
+
+class test_pipeline_compressed(test_pipeline):
+    def setUp(self):
+        test_pipeline.setUp(self)
+        self.trackopts['storage'] = dict(flush_frames=2, complevel=5, complib='zlib')
+
+class test_pipeline_schema(test_pipeline):
+    def setUp(self):
+        test_pipeline.setUp(self)
+        self.trackopts['storage'] = dict(frame_dtype='int32', particle_dtype='int64',
+                float_dtype='float64', drop_columns='rg2')
+    def test_schema(self):
+        track.track2disk(self.frames(), self.outputfile, self.params, **self.trackopts)
+        h5 = tables.openFile(self.outputfile, 'r')
+        try:
+            schema = track.tracks_schema(h5.root.bigtracks)
+        finally:
+            h5.close()
+        assert schema == [('frame', 'int32'), ('particle', 'int64'), ('x', 'float64'),
+                ('y', 'float64'), ('intensity', 'float64')]
+
+class test_pipeline_sorted(test_pipeline):
+    def setUp(self):
+        test_pipeline.setUp(self)
+        self.trackopts['storage'] = dict(sort_by_particle=1, index_optlevel=9)
+    def test_trajectory(self):
+        track.track2disk(self.frames(), self.outputfile, self.params, **self.trackopts)
+        alltracks = BigTracks(self.outputfile).get_all()
+        h5 = tables.openFile(self.outputfile, 'r')
+        try:
+            assert h5.root.particles.nrows == len(alltracks.particle.unique())
+            assert h5.root.particles.cols.length[:].sum() == len(alltracks)
+            traj = track.read_trajectory(h5, 0)
+        finally:
+            h5.close()
+        expected = alltracks[alltracks.particle == 0].sort('frame')
+        assert (traj.frame.values == expected.frame.values).all()
+        assert np.allclose(traj.x.values, expected.x.values)
+    def test_convert_old_file(self):
+        track.track2disk(self.frames(), self.outputfile, self.params)
+        h5 = tables.openFile(self.outputfile, 'a')
+        try: # Files from before checkpoints have no attributes.
+            attrs = h5.root.bigtracks.attrs
+            for name in list(attrs._v_attrnamesuser):
+                delattr(attrs, name)
+        finally:
+            h5.close()
+        track.create_tracksfile_indices(self.outputfile, self.trackopts['storage'])
+        h5 = tables.openFile(self.outputfile, 'r')
+        try:
+            assert h5.root.bytracks.nrows == h5.root.bigtracks.nrows
+            assert h5.root.particles.cols.length[:].sum() == h5.root.bigtracks.nrows
+        finally:
+            h5.close()
+
+class test_pipeline_status_db(test_pipeline):
+    def test_runner(self):
+        # The movie is reached through a symbolic link.
+        linkdir = tempfile.mkdtemp()
+        try:
+            moviedir = os.path.join(linkdir, 'movie')
+            os.symlink(self.testdir, moviedir)
+            statusdb = os.path.join(linkdir, 'status.sqlite')
+            runner = run.TrackingRunner([moviedir], quickparams=self.params,
+                    frames_pattern='*.' + self.extension,
+                    tracksfilename=os.path.basename(self.outputfile), status_db=statusdb)
+            assert runner.read_statuses().status.values[0] == 'waiting'
+            runner.run(0)
+            statuses = runner.read_statuses()
+            assert statuses.status.values[0] == 'done'
+            assert statuses.totalframes.values[0] == self.nframes
+            assert statuses.output.values[0] == 'yes'
+            # A finished job whose output has been deleted is waiting again.
+            os.remove(self.outputfile)
+            statuses = runner.read_statuses()
+            assert statuses.output.values[0] == ''
+            assert statuses.status.values[0] == 'waiting'
+            history = runner.throughput_history(0)
+            assert len(history) > 0
+            assert (history.frames_per_sec.values > 0).all()
+            runner._clear_status(runner.movies[0])
+            assert runner.read_statuses().status.values[0] == 'waiting'
+            assert len(runner.throughput_history(0)) == 0
+        finally:
+            shutil.rmtree(linkdir)
+
+class test_pipeline_local_workers(test_pipeline):
+    def test_runner(self):
+        # A second movie, with the same frames
+        moviedir = os.path.join(self.testdir, 'movie2')
+        os.mkdir(moviedir)
+        for fn in self.frames():
+            shutil.copy(fn, moviedir)
+        runner = run.TrackingRunner([self.testdir, moviedir], quickparams=self.params,
+                frames_pattern='*.' + self.extension,
+                tracksfilename=os.path.basename(self.outputfile), workers=2)
+        try:
+            runner.start()
+            for i in range(2):
+                runner.parallel_results_mostrecent[i].get(timeout=300)
+        finally:
+            runner.load_balanced_view.shutdown()
+        statuses = runner.read_statuses()
+        assert (statuses.status.values == 'done').all()
+        assert (statuses.output.values == 'yes').all()
+        for d in (self.testdir, moviedir):
+            bt = BigTracks(os.path.join(d, os.path.basename(self.outputfile)))
+            assert len(bt.get_all()) == self.nframes * self.nparticles
+
+class test_pipeline_resume(test_pipeline):
+    def test_resume(self):
+        imgfiles = sorted(self.frames())
+        fullfile = os.path.join(self.testdir, 'bttest_full.h5')
+        track.track2disk(imgfiles, fullfile, self.params)
+        # Simulate a run that stopped after 2 frames, then resume it.
+        track.track2disk(imgfiles, self.outputfile, self.params, selectframes=[1, 2],
+                storage=dict(checkpoint_frames=1))
+        track.track2disk(imgfiles, self.outputfile, self.params, resume=True)
+        full = BigTracks(fullfile).get_all().sort(['frame', 'particle'])
+        resumed = BigTracks(self.outputfile).get_all().sort(['frame', 'particle'])
+        assert len(resumed) == len(full)
+        assert (resumed.particle.values == full.particle.values).all()
+    def test_resume_midrun(self):
+        for framenumber in range(self.nframes, 12):
+            x, y, img = fake_image(framenumber)
+            scipy.misc.imsave(os.path.join(self.testdir, 
+                'bttest_%.4i.%s' % (framenumber, self.extension)), img)
+        imgfiles = sorted(self.frames())
+        params = dict(self.params, memory=2)
+        storage = dict(flush_frames=1, checkpoint_frames=3)
+        fullfile = os.path.join(self.testdir, 'bttest_full.h5')
+        track.track2disk(imgfiles, fullfile, params)
+        # Stop at frame 9, after rows for frames 7 and 8 were written past
+        # the checkpoint at frame 6.
+        broken = list(imgfiles)
+        broken[8] = os.path.join(self.testdir, 'missing.' + self.extension)
+        try:
+            track.track2disk(broken, self.outputfile, params, storage=storage)
+        except (IOError, OSError):
+            pass
+        else:
+            raise AssertionError('Tracking did not stop at the missing frame.')
+        h5 = tables.openFile(self.outputfile, 'r')
+        try:
+            attrs = h5.root.bigtracks.attrs
+            assert attrs.checkpoint_frame == 6
+            assert h5.root.bigtracks.nrows > attrs.checkpoint_nrows
+            assert h5.root.bigtracks.cols.frame[-1] == 8
+        finally:
+            h5.close()
+        track.track2disk(imgfiles, self.outputfile, params, storage=storage, resume=True)
+        full = BigTracks(fullfile).get_all()
+        resumed = BigTracks(self.outputfile).get_all()
+        assert len(resumed) == len(full)
+        for fnum in range(1, 13):
+            f = full[full.frame == fnum].sort(['x', 'y'])
+            r = resumed[resumed.frame == fnum].sort(['x', 'y'])
+            assert len(r) == len(f)
+            assert (r.particle.values == f.particle.values).all()
+            assert np.allclose(r.x.values, f.x.values)
+
+class test_pipeline_blocks(test_pipeline):
+    def setUp(self):
+        test_pipeline.setUp(self)
+        self.trackopts['blocksize'] = 2
@@ -12,20 +12,75 @@ The 'params' dictionaries required below have the following options:
             Default: basic bandpass-supbixel algorithm.
         'maxgray': Maximum grayscale value of images (default 0 -> best guess)
         'bright': 0 -> dark particles on light background (default); 1 -> inverse
+        'float32': 1 -> read and process images in single precision, which halves
+            memory traffic at the cost of slightly different results (default 0).
         [Depending on 'identfunc', the following parameters may be different.]
         'featsize': Expected particle feature radius
         'bphigh': Scale, in pixels, for smoothing images and making them more lumpy
         'maxrg': Cutoff for particle radius of gyration --- how extended particle is
         'threshold': Ignore pixels smaller than this value
+        'bp_method': Method for band-pass filtering blocks of frames: "auto" (default),
+            "direct", or "fft". See identification.band_pass_stack().
+        'lm_engine': Method for finding local maxima: "auto" (default), "dense", or
+            "sparse". See identification.find_local_max(). Results are the same.
         'merge_cutoff': Merge features that are too close to each other.
+        'merge_method': "clusters" (default) merges whole clusters; "legacy"
+            reproduces the incomplete merging of older versions.
+        'tilesize': Identify features in square tiles of this many pixels 
+            (default 0 -> whole frames), to limit memory use with huge frames.
+            Results are the same. See identify_frame_tiled().
+        'tile_workers': Number of threads for processing tiles (default 1).
+            The threads are kept for the life of the process.
+        'crop_window': 1 -> with a 'window', read and filter only the part of 
+            each frame near the window, which is much faster for a small window.
+            The band-passed image is then normalized by its maximum within 
+            the window, instead of the whole frame, so 'threshold', 'intensity',
+            and 'rg2' are relative to the window. 0 (default) otherwise.
+        'zscale': For 3D tracking (identfunc "identify_volume_basic"), spacing
+            between z slices, in units of x-y pixels (default 1). Sizes are 
+            scaled accordingly along z, and z is multiplied by 'zscale' 
+            when merging and linking. Coordinates are still reported in slices.
+        'zslices': For a stack file of 2D frames, number of consecutive frames 
+            that make up each volume (default 0 -> not volumetric).
     For tracking:
         'maxdisp': Radius of region in which to look for a particle in the next frame.
             Set too high, and the algorithm will be overwhelmed with possible matches.
         'memory': How many frames a particle can skip, and still be identified if it has
             not moved past 'maxdisp'.
 
+The 'storage' dictionaries control how track2disk() writes to disk. All are optional:
+    'flush_frames': Write to disk after this many frames have accumulated (default 1).
+    'flush_mb': Also write once this many MB have accumulated (default 0 -> no limit).
+    'complevel': Compression level, 0-9 (default 0 -> no compression).
+    'complib': Compression library: 'blosc' (default), 'zlib', 'lzo', or 'bzip2'.
+    'shuffle': 1 (default) to shuffle bytes before compressing, which helps a lot
+        with floating-point data; 0 otherwise.
+    'checkpoint_frames': Record a checkpoint, for resuming an interrupted run, at
+        the first write after this many frames (default 100; 0 -> only at the end).
+    'chunkrows': Rows per HDF5 chunk (default 0 -> let PyTables decide). Larger 
+        chunks compress better, but make reading small pieces of the table slower.
+    'frame_dtype', 'particle_dtype': Type of the 'frame' and 'particle' columns:
+        'float32' (default, for compatibility), 'int32', or 'int64'. A float32 
+        holds integers exactly only up to 2**24 (~1.7e7).
+    'float_dtype': Type of the coordinates, 'intensity', and 'rg2': 'float32'
+        (default) or 'float64'.
+    'drop_columns': List (or comma-separated string) of columns to leave out:
+        'intensity' and/or 'rg2'.
+    'index_kind', 'index_optlevel': Kind ('ultralight', 'light', 'medium' (default),
+        or 'full') and optimization level (0-9, default 6) of the indexes created
+        on 'frame' and 'particle' when tracking is finished.
+    'sort_by_particle': 1 -> when finished, also write 'bytracks', a copy of the 
+        table sorted by particle, and 'particles', the first row and number of 
+        rows of each particle in 'bytracks', so that any trajectory can be read
+        as one contiguous slice (see read_trajectory()). The sort uses a 
+        completely sorted index on 'particle', which, like the lookup table, 
+        is built out of core. 0 (default) otherwise.
+The status file reports the resulting write throughput and compression ratio.
+The layout of the tracks table is recorded in its attributes; see tracks_schema().
+
 The 'window' dictionaires limit where and when to look for particles. 
-Items 'xmin', 'xmax', 'ymin', and 'ymax' set the spatial limits. 'firstframe' 
+Items 'xmin', 'xmax', 'ymin', and 'ymax' (and 'zmin' and 'zmax' for volumes) 
+set the spatial limits. 'firstframe' 
 and 'lastframe' set the range of frames to track, inclusive; the first frame 
 is numbered 1. All values are optional. 
 
@@ -53,36 +108,135 @@ See track2disk() for something much more user-friendly.
 #You should have received a copy of the GNU General Public License
 #along with this program; if not, see <http://www.gnu.org/licenses>.
 
-import os, sys, itertools, importlib
+import os, sys, time, json, itertools, importlib, threading
 import numpy as np
 import scipy.misc
 from scipy.spatial import cKDTree
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
 import pandas, tables
 import trackpy.feature, trackpy.linking, trackpy.predict
-from . import identification
+from . import identification, framesources
 from .util import readSingleCfg
-from .statusboard import StatusFile, Stopwatch, format_td
+from .statusboard import open_status, Stopwatch, format_td, StageTimes, \
+        stage_laps, enable_stage_timing, current_stage_times, mark_concurrent_thread
 
-# I've coded this with 32-bit floats to save disk space and bandwidth.
-# The native data type of pandas is a 64-bit float.
-# If you have more than ~10^7 particles and/or frames, you want 64 bits.
-# Just remove all the casts to 'float32' and 'float64', and redefine the pytables
-# columns as Float64Col, and you should be all set.
-# Note that there will be pandas trouble if the pytables definition mixes 
-# 32- and 64-bit fields.
+# By default, tracks are stored as 32-bit floats to save disk space and bandwidth.
+# If you have more than ~10^7 particles and/or frames, use integer 'frame' and
+# 'particle' columns; see the 'storage' options in the module docs.
 
 # Nuts and bolts of individual tracking operations
 def identify_frame(im, params, window=None):
     """Identify features in image array 'im' and return a DataFrame
 
     Uses the function determined and loaded by get_identify_function().
-    Loading that function can be expensive, so it's better to get the function
-    returned by get_identify_function() and use that yourself if many
-    frames are to be processed.
+    Loading that function can be expensive, so if many frames are to be
+    processed, it's better to make an IdentificationPlan and use that.
     """
-    if float(params.get('bright', 0)):
-        im = 1 - im
-    return get_identify_function(params)(im, params, window=window)
+    return IdentificationPlan(params, window).identify(im)
+class IdentificationPlan(object):
+    """Everything needed to identify features in a movie, resolved once.
+
+    Loads the identification function (see get_identify_function()) and the
+    'window' (if "file"), and casts the numerical parameters in 'params'
+    (see compile_params()). identify() and identify_frames() then need to
+    do only the per-frame work.
+
+    With the basic identification function and the 'crop_window' parameter, 
+    images are cropped to 'window' (plus the margin needed by the filters) 
+    before anything else is done; see identify_frame_tiled(). 'raw_frames' is
+    then True (as with 'tilesize'), meaning that frames may be read with read()
+    without normalizing them.
+
+    A plan can be pickled and sent to worker processes, provided that the
+    identification function is defined at the top level of a module.
+    """
+    def __init__(self, params, window=None):
+        self.params = compile_params(params)
+        self.function = get_identify_function(self.params)
+        if window == 'file':
+            window = get_window()
+        self.window = window
+        self.bright = bool(self.params.get('bright', 0))
+        # Tiling and cropping only apply to the basic function
+        basic = self.function is identify_frame_basic
+        self.tiled = basic and bool(self.params.get('tilesize', 0))
+        self.cropped = basic and window is not None and \
+                bool(self.params.get('crop_window', 0))
+        self.raw_frames = self.tiled or self.cropped
+    def read(self, filename):
+        """Read an image for identify(), using imread()."""
+        return imread(filename, self.params, raw=self.raw_frames)
+    def identify(self, im):
+        """Identify features in image array 'im' and return a DataFrame."""
+        stage_laps().start()
+        if self.tiled or self.cropped:
+            return identify_frame_tiled(im, self.params, window=self.window, 
+                    bright=self.bright, crop=self.cropped)
+        if self.bright:
+            im = np.asarray(im)
+            if im.dtype.kind == 'f':
+                im = np.subtract(1, im, identification.thread_workspace().buffer(
+                    'identify_frame_bright', im.shape, im.dtype))
+            else:
+                im = 1 - im
+        return self.function(im, self.params, window=self.window)
+    def identify_frames(self, ims):
+        """Identify features in a sequence of image arrays; see identify_frames()."""
+        if self.function is not identify_frame_basic or self.tiled or \
+                (self.cropped and _empty_region(np.shape(ims[0]), self.params, self.window)):
+            return [self.identify(im) for im in ims]
+        params = self.params
+        featsize = params.get('featsize', 3)
+        laps = stage_laps()
+        laps.start()
+        if self.cropped:
+            # Process the same region of every frame
+            shape = np.shape(ims[0])
+            y0, y1, x0, x1 = _window_region(shape, params, self.window)
+            halo = _filter_margin(params)
+            ya, xa = max(y0 - halo, 0), max(x0 - halo, 0)
+            yb, xb = min(y1 + halo, shape[0]), min(x1 + halo, shape[1])
+            ims = [_prepare_tile(im[ya:yb, xa:xb], params) for im in ims]
+            core = (x0 - xa, x1 - xa, y0 - ya, y1 - ya)
+        else:
+            ya = xa = 0
+            core = None
+        ims = np.asarray(ims, dtype=np.float32 if params.get('float32', 0) else float)
+        if self.bright:
+            ims = 1 - ims
+        imbps = identification.band_pass_stack(ims, params.get('bplow', featsize), 
+                params.get('bphigh', 0.7), method=params.get('bp_method', 'auto'),
+                normalize=not self.cropped)
+        laps.mark('band_pass')
+        workspace = identification.thread_workspace()
+        results = []
+        for imbp in imbps:
+            if self.cropped: # Normalize by the maximum in the window, as when tiled
+                cx0, cx1, cy0, cy1 = core
+                df = _scale_features(_raw_features(imbp, params, workspace=workspace, 
+                    core=core), imbp[cy0:cy1, cx0:cx1].max(), params)
+            else:
+                df = _bandpassed_features(imbp, params, workspace=workspace)
+            df['x'] += xa
+            df['y'] += ya
+            results.append(postprocess_features(df, params, window=self.window))
+        return results
+# Types of the numerical parameters, so that they can be cast once per run.
+PARAM_TYPES = dict(maxgray=float, bright=float, float32=int, featsize=int, 
+        bphigh=float, bplow=int, maxrg=float, threshold=float, merge_cutoff=float,
+        zscale=float, zslices=int, tilesize=int, tile_workers=int, crop_window=int,
+        maxdisp=float, memory=int)
+def compile_params(params):
+    """Copy of 'params' with the values listed in PARAM_TYPES cast to numbers.
+    
+    Values in "trackpy.ini" are strings; casting them once, instead of in 
+    each function that uses them, saves time when frames are small."""
+    params = dict(params)
+    for k, typ in PARAM_TYPES.items():
+        if k in params and params[k] is not None:
+            params[k] = typ(params[k])
+    return params
 def get_identify_function(params):
     """Based on the 'identfunc' and 'identmod' elements in 'params', decide which 
     function to use, then pass 'params' to that function. That function
@@ -116,19 +270,240 @@ def identify_frame_basic(im, params, window=None):
     featsize = int(params.get('featsize', 3))
     bphigh = float(params.get('bphigh', 0.7))
     bplow = int(params.get('bplow', featsize))
-    threshold = float(params.get('threshold', 1e-15))
+    if int(params.get('float32', 0)):
+        im = np.asarray(im, dtype=np.float32)
+    # Intermediate images are kept in buffers that are reused for each frame.
+    workspace = identification.thread_workspace()
     # Feature identification
-    imbp = identification.band_pass(im, bplow, bphigh)
-    lm = identification.find_local_max(imbp, featsize, threshold=threshold)
+    imbp = identification.band_pass(im, bplow, bphigh, workspace=workspace)
+    stage_laps().mark('band_pass')
+    return _identify_bandpassed(imbp, params, window=window, workspace=workspace)
+def _identify_bandpassed(imbp, params, window=None, workspace=None):
+    """Remainder of identify_frame_basic(), after band-pass filtering."""
+    df = _bandpassed_features(imbp, params, workspace=workspace)
+    return postprocess_features(df, params, window=window)
+def _bandpassed_features(imbp, params, workspace=None, core=None, peaks=False):
+    """Locate features in band-passed image 'imbp', without postprocessing.
+
+    If 'core' is given as (xmin, xmax, ymin, ymax), only local maxima in 
+    that range (including the minima, excluding the maxima) are kept.
+    If 'peaks', the value of 'imbp' at each local maximum is in column '_peak'.
+    """
+    featsize = int(params.get('featsize', 3))
+    threshold = float(params.get('threshold', 1e-15))
+    laps = stage_laps()
+    lm = identification.find_local_max(imbp, featsize, threshold=threshold,
+            engine=params.get('lm_engine', 'auto'), workspace=workspace)
+    laps.mark('find_local_max')
     lmcrop = identification.local_max_crop(imbp, lm, featsize)
+    if core is not None:
+        xmin, xmax, ymin, ymax = core
+        lmcrop = lmcrop.compress((lmcrop[0] >= xmin) & (lmcrop[0] < xmax) &
+                (lmcrop[1] >= ymin) & (lmcrop[1] < ymax), axis=1)
     pos, m, r2 = identification.subpixel_centroid(imbp, lmcrop, featsize, struct_shape='circle')
+    laps.mark('subpixel_centroid')
     # Munging
     df = pandas.DataFrame({'x': pos[0,:], 'y': pos[1,:], 'intensity': m, 'rg2': r2})
+    if peaks:
+        df['_peak'] = imbp[lmcrop[1], lmcrop[0]]
+    return df
+def _raw_features(imbp, params, workspace=None, core=None):
+    """_bandpassed_features() for an un-normalized band-passed image. 
+    
+    All local maxima above 0 are kept, with '_peak' values, so that the
+    threshold can be applied by _scale_features() once the scale is known."""
+    if float(params.get('threshold', 1e-15)) > 0:
+        params = dict(params, threshold=np.finfo(imbp.dtype).tiny)
+    return _bandpassed_features(imbp, params, workspace=workspace, core=core, 
+            peaks=True)
+def _scale_features(df, scale, params):
+    """Features from _raw_features(), as if the band-passed image had been 
+    divided by 'scale' (its maximum) before they were found."""
+    if not scale > 0: # Blank image; band_pass() would give NaNs, and no features.
+        return df[:0].drop('_peak', axis=1)
+    threshold = float(params.get('threshold', 1e-15))
+    df = df[df['_peak'].values / scale >= threshold].drop('_peak', axis=1)
+    df['intensity'] = df['intensity'] / scale
+    df['rg2'] = df['rg2'] / scale
+    return df
+def identify_frame_tiled(im, params, window=None, bright=False, crop=False):
+    """identify_frame_basic(), for frames too large to process all at once.
+
+    The frame is divided into square tiles of 'tilesize' pixels (a parameter;
+    default 0 -> one tile), which are filtered independently, so that temporary
+    arrays are only as large as a tile. If 'im' is memory-mapped (see the 
+    framesources module), the frame is never read into memory all at once. 
+    Unless 'im' is already floating-point, each tile is normalized as by 
+    track.imread(). If 'bright', each tile is inverted, as identify_frame() 
+    does to whole frames.
+
+    Each tile is extended by a halo, wide enough that filtering and centroiding 
+    near its edges give the same results as for the whole frame. A feature is
+    kept only by the tile whose interior contains its local maximum, so that 
+    each feature is found exactly once. Tiles are not normalized separately:
+    features are found in the un-normalized band-passed tiles, and then 
+    thresholded and scaled by the maximum of the whole band-passed frame, so 
+    that results are the same as for identify_frame_basic(). Features are 
+    only sought in the part of the frame that can contain features inside 
+    'window', but the whole frame must still be filtered to find the maximum.
+
+    If 'crop', only that part of the frame is filtered (and read), and its own
+    maximum is used instead. This is much faster for a small 'window', but 
+    'threshold', 'intensity', and 'rg2' are then relative to the window.
+
+    If the 'tile_workers' parameter is greater than 1, tiles are processed 
+    in that many threads.
+    """
+    if window == 'file':
+        window = get_window()
+    featsize = int(params.get('featsize', 3))
+    bphigh = float(params.get('bphigh', 0.7))
+    bplow = int(params.get('bplow', featsize))
+    halo = _filter_margin(params)
+    ny, nx = im.shape
+    # Features are sought in 'fregion'; 'region' is filtered.
+    fy0, fy1, fx0, fx1 = _window_region(im.shape, params, window)
+    if crop:
+        ry0, ry1, rx0, rx1 = fy0, fy1, fx0, fx1
+    else:
+        ry0, ry1, rx0, rx1 = 0, ny, 0, nx
+    tilesize = int(params.get('tilesize', 0)) or max(ry1 - ry0, rx1 - rx0, 1)
+    def identify_tile(corner):
+        """Returns (maximum of band-passed tile interior, features or None)."""
+        stage_laps().start()
+        y0, x0 = corner
+        y1, x1 = min(y0 + tilesize, ry1), min(x0 + tilesize, rx1)
+        ya, xa = max(y0 - halo, 0), max(x0 - halo, 0)
+        tile = _prepare_tile(im[ya:min(y1 + halo, ny), xa:min(x1 + halo, nx)], 
+                params, bright)
+        workspace = identification.thread_workspace()
+        imbp = identification.band_pass(tile, bplow, bphigh, workspace=workspace,
+                normalize=False)
+        stage_laps().mark('band_pass')
+        tilemax = imbp[y0 - ya:y1 - ya, x0 - xa:x1 - xa].max()
+        cy0, cy1, cx0, cx1 = max(y0, fy0), min(y1, fy1), max(x0, fx0), min(x1, fx1)
+        if cy1 <= cy0 or cx1 <= cx0:
+            return tilemax, None
+        df = _raw_features(imbp, params, workspace=workspace,
+                core=(cx0 - xa, cx1 - xa, cy0 - ya, cy1 - ya))
+        df['x'] += xa
+        df['y'] += ya
+        return tilemax, df
+    corners = [(y0, x0) for y0 in range(ry0, ry1, tilesize) 
+            for x0 in range(rx0, rx1, tilesize)]
+    tile_workers = int(params.get('tile_workers', 1))
+    if tile_workers > 1 and len(corners) > 1:
+        results = _tile_pool(tile_workers).map(identify_tile, corners, chunksize=1)
+        # The stages of each tile are timed in its thread, as 'remote'.
+        stage_laps().mark('tiles')
+    else:
+        results = [identify_tile(c) for c in corners]
+    found = [df for tilemax, df in results if df is not None]
+    if found:
+        df = _scale_features(pandas.concat(found, ignore_index=True),
+                max(tilemax for tilemax, df in results), params)
+    else: # Window is outside the frame
+        df = pandas.DataFrame({'x': [], 'y': [], 'intensity': [], 'rg2': []})
     return postprocess_features(df, params, window=window)
+_tile_pools = {}
+_tile_pools_lock = threading.Lock()
+def _tile_pool(nthreads):
+    """ThreadPool of 'nthreads' for identify_frame_tiled(), shared by all
+    calls in this process, so that each thread keeps its workspace."""
+    # Keyed by process ID, since a forked child does not inherit the threads.
+    key = (os.getpid(), nthreads)
+    with _tile_pools_lock:
+        if key not in _tile_pools:
+            from multiprocessing.pool import ThreadPool
+            _tile_pools[key] = ThreadPool(nthreads, initializer=mark_concurrent_thread)
+        return _tile_pools[key]
+def _filter_margin(params):
+    """Pixels around a region that affect identify_frame_basic() inside it."""
+    featsize = int(params.get('featsize', 3))
+    bphigh = float(params.get('bphigh', 0.7))
+    bplow = int(params.get('bplow', featsize))
+    # band_pass() zeroes a border of 2 * bplow + 1, and its Gaussian filter 
+    # reaches 4 sigma. Local maxima and centroids then need 'featsize'.
+    return 2 * bplow + 1 + int(np.ceil(4 * bphigh)) + featsize
+def _window_region(shape, params, window):
+    """Range of pixels (ymin, ymax, xmin, xmax) in which a local maximum can
+    give a feature inside 'window'. Maxima are exclusive."""
+    ny, nx = shape
+    if window is None:
+        return 0, ny, 0, nx
+    # A centroid is within 'featsize' of its local maximum.
+    pad = int(params.get('featsize', 3)) + 1
+    def bounds(lo, hi, size):
+        return (int(min(max(np.floor(lo) - pad, 0), size)), 
+                int(max(min(np.ceil(hi) + pad + 1, size), 0)))
+    y0, y1 = bounds(window['ymin'], window['ymax'], ny)
+    x0, x1 = bounds(window['xmin'], window['xmax'], nx)
+    return y0, y1, x0, x1
+def _empty_region(shape, params, window):
+    y0, y1, x0, x1 = _window_region(shape, params, window)
+    return y1 <= y0 or x1 <= x0
+def _prepare_tile(tile, params, bright=False):
+    """Normalize (if not floating-point) and optionally invert part of a frame."""
+    if tile.dtype.kind != 'f':
+        tile = framesources.normalize_image(tile, params)
+    elif int(params.get('float32', 0)):
+        tile = np.asarray(tile, dtype=np.float32)
+    if bright:
+        tile = 1 - tile
+    return tile
+def identify_volume_basic(im, params, window=None):
+    """Bandpass-subpixel feature identification in a 3D (z, y, x) volume.
+
+    Returns a DataFrame with columns 'x', 'y', 'z', 'intensity', 'rg2'. 
+    Coordinates are in pixels and slices, respectively.
+
+    Parameters are as for identify_frame_basic(), in units of x-y pixels. 
+    'zscale' is the spacing of slices in those units, so that sizes along z 
+    are divided by 'zscale' (but are at least 1 slice). Masses and 'rg2' are 
+    computed with a diamond-shaped mask.
+
+    For cropping, 'window' may also have 'zmin' and 'zmax'.
+    """
+    featsize = int(params.get('featsize', 3))
+    bphigh = float(params.get('bphigh', 0.7))
+    bplow = int(params.get('bplow', featsize))
+    threshold = float(params.get('threshold', 1e-15))
+    zscale = float(params.get('zscale', 1))
+    if int(params.get('float32', 0)):
+        im = np.asarray(im, dtype=np.float32)
+    im = np.asarray(im)
+    if im.ndim != 3:
+        raise ValueError('Expected a 3D volume; got shape %r' % (im.shape,))
+    def radii(r):
+        return (max(int(round(r / zscale)), 1), int(r), int(r))
+    workspace = identification.thread_workspace()
+    imbp = identification.band_pass(im, radii(bplow), (bphigh / zscale, bphigh, bphigh),
+            workspace=workspace)
+    laps = stage_laps()
+    laps.mark('band_pass')
+    lm = identification.find_local_max(imbp, radii(featsize), threshold=threshold,
+            engine=params.get('lm_engine', 'auto'), workspace=workspace)
+    laps.mark('find_local_max')
+    lmcrop = identification.local_max_crop(imbp, lm, radii(featsize))
+    pos, m, r2 = identification.subpixel_centroid_nd(imbp, lmcrop, radii(featsize))
+    laps.mark('subpixel_centroid')
+    df = pandas.DataFrame({'x': pos[0,:], 'y': pos[1,:], 'z': pos[2,:], 
+        'intensity': m, 'rg2': r2})
+    return postprocess_features(df, params, window=window)
+def identify_frames(ims, params, window=None):
+    """Identify features in a sequence of image arrays, and return a list of DataFrames.
+
+    With the default identification function, the frames are band-pass 
+    filtered together, as a (T, Y, X) block; see identification.band_pass_stack().
+    Other functions are applied frame by frame, as with identify_frame().
+    """
+    return IdentificationPlan(params, window).identify_frames(ims)
 def postprocess_features(df, params, window=None):
     """Apply standard cuts, cropping, merging to a features DataFrame."""
     # This could be used by custom feature identification functions defined in
     # other files.
+    laps = stage_laps()
+    laps.mark('identify') # Anything not timed as a more specific stage
     maxrg = float(params.get('maxrg', np.inf))
     merge_cutoff = float(params.get('merge_cutoff', -1))
     # Radius of gyration cut
@@ -139,42 +514,237 @@ def postprocess_features(df, params, window=None):
             window = get_window()
         feats = feats[(feats.x > window['xmin']) & (feats.x < window['xmax']) & \
                 (feats.y > window['ymin']) & (feats.y < window['ymax'])]
+        if 'z' in feats:
+            feats = feats[(feats.z > window.get('zmin', -np.inf)) & 
+                    (feats.z < window.get('zmax', np.inf))]
     # Merge nearby particles
-    if merge_cutoff <= 0:
-        return feats
-    else:
-        return merge_groups(feats, merge_cutoff)
-def feature_iter(filename_pairs, params, window=None):
+    if merge_cutoff > 0:
+        feats = merge_groups(feats, merge_cutoff, 
+                method=params.get('merge_method', 'clusters'),
+                zscale=float(params.get('zscale', 1)))
+    laps.mark('postprocess')
+    return feats
+def feature_iter(filename_pairs, params, window=None, workers=None, blocksize=None):
     """Convert a sequence of (frame number, filename) into a sequence of features data.
     
-    Note that this uses the track.imread(), not that from e.g. pylab."""
-    for fnum, filename in filename_pairs:
-        # NOTE that this imread is not like the matplotlib version, which is
-        # already normalized.
-        # We use this version because importing matplotlib is very expensive.
-        ftr = identify_frame(imread(filename, params),
-                params, window=window)
+    Note that this uses the track.imread(), not that from e.g. pylab.
+
+    If 'workers' is greater than 1, frames are read and identified in a pool of
+    that many processes. Results are still yielded in frame order.
+
+    If 'blocksize' is greater than 1, frames are read and identified in blocks
+    of that many, using identify_frames(). With 'workers', each worker process 
+    handles a whole block at a time.
+
+    The identification function, parameters, and window are resolved once, 
+    as an IdentificationPlan.
+    """
+    blocks = _blocks(filename_pairs, int(blocksize or 1))
+    if workers is not None and int(workers) > 1:
+        results = _feature_iter_pool(blocks, params, window, int(workers))
+    else:
+        plan = IdentificationPlan(params, window)
+        results = (_identify_files(block, plan) for block in blocks)
+    return (item for result in results for item in result)
+def stored_feature_iter(filename_pairs, store, params, window=None, link_only=False, 
+        flush_frames=100, **kw):
+    """Like feature_iter(), but takes features from the FeatureStore 'store' 
+    when they are there, and adds newly identified features to it.
+
+    Extra keyword arguments are passed to feature_iter(), which identifies
+    the frames that are not in the store. If 'link_only', all frames must be
+    in the store already.
+    """
+    filename_pairs = list(filename_pairs)
+    keys = [store.image_key(filename) for fnum, filename in filename_pairs]
+    missing = [pair for pair, key in itertools.izip(filename_pairs, keys) 
+            if key not in store.index]
+    if missing and link_only:
+        raise ValueError('%i of %i frames are not in the feature store "%s"' % 
+                (len(missing), len(filename_pairs), store.filename))
+    identified = feature_iter(missing, params, window=window, **kw)
+    nnew = 0
+    for (fnum, filename), key in itertools.izip(filename_pairs, keys):
+        ftr = store.get(filename, key=key)
+        if ftr is None:
+            ifnum, ftr = next(identified)
+            store.put(filename, ftr, key=key)
+            nnew += 1
+            if nnew % flush_frames == 0:
+                store.flush()
         yield fnum, ftr
-def imread(filename, params=None):
+    store.flush()
+def _blocks(iterable, blocksize):
+    """Group 'iterable' into lists of up to 'blocksize' items."""
+    it = iter(iterable)
+    while True:
+        block = list(itertools.islice(it, blocksize))
+        if not block:
+            return
+        yield block
+def _timed_waits(iterable, stage):
+    """Iterate over 'iterable', timing the wait for each item as 'stage'."""
+    laps = stage_laps()
+    laps.start()
+    for item in iterable:
+        laps.mark(stage)
+        yield item
+def _identify_files(filename_pairs, plan):
+    """Read and identify a list of (frame number, filename), according to the
+    IdentificationPlan 'plan'. Returns a list of (frame number, DataFrame).
+
+    Defined at module level so that it can be sent to worker processes."""
+    # NOTE that this imread is not like the matplotlib version, which is
+    # already normalized.
+    # We use this version because importing matplotlib is very expensive.
+    laps = stage_laps()
+    image_pairs = []
+    for fnum, filename in filename_pairs:
+        laps.start()
+        image_pairs.append((fnum, plan.read(filename)))
+        laps.mark('read')
+    return _identify_images(image_pairs, plan)
+def _identify_files_timed(filename_pairs, plan):
+    """_identify_files() in a worker process, with stage timing enabled.
+    Returns the results and a list of (stage, seconds)."""
+    times = StageTimes(window=None)
+    enable_stage_timing(times)
+    try:
+        results = _identify_files(filename_pairs, plan)
+    finally:
+        enable_stage_timing(None)
+    return results, [(stage, t) for stage, samples in times.samples.items()
+            for t in samples]
+def _identify_images(image_pairs, plan):
+    """Identify a list of (frame number, image array), as one block if there
+    are several. Returns a list of (frame number, DataFrame)."""
+    if len(image_pairs) == 1:
+        fnum, im = image_pairs[0]
+        return [(fnum, plan.identify(im))]
+    fnums = [fnum for fnum, im in image_pairs]
+    return zip(fnums, plan.identify_frames([im for fnum, im in image_pairs]))
+def _feature_iter_pool(blocks, params, window, workers):
+    """Identify blocks of frames in a pool of 'workers' processes, yielding 
+    results in order.
+
+    At most 2 * 'workers' blocks are in flight at once, so that a slow consumer
+    (e.g. the linker) does not cause results to pile up in memory.
+    """
+    import multiprocessing, collections
+    # A custom predictor object is only needed by the linker, and may not pickle.
+    idparams = dict((k, v) for k, v in params.items() if k != 'predictor')
+    plan = IdentificationPlan(idparams, window)
+    maxpending = 2 * workers
+    times = current_stage_times()
+    laps = stage_laps()
+    if times is not None:
+        # Workers time their stages, and send the results back.
+        func = _identify_files_timed
+        def result(async_result):
+            features, samples = async_result.get()
+            # Time this process spent waiting for identification
+            laps.mark('wait_identify')
+            times.extend(samples, remote=True)
+            return features
+    else:
+        func = _identify_files
+        result = lambda async_result: async_result.get()
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = collections.deque()
+        for block in blocks:
+            pending.append(pool.apply_async(func, (block, plan)))
+            if len(pending) >= maxpending:
+                yield result(pending.popleft())
+        while pending:
+            yield result(pending.popleft())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+def image_iter(filename_pairs, params=None, raw=False, concurrent=False):
+    """Convert a sequence of (frame number, filename) into a sequence of
+    (frame number, image array), using track.imread().
+    
+    If 'concurrent', the images are read in a background thread (see
+    pipeline.Prefetcher), and reading is timed as 'remote'."""
+    if concurrent:
+        mark_concurrent_thread()
+    laps = stage_laps()
+    for fnum, filename in filename_pairs:
+        laps.start()
+        im = imread(filename, params, raw=raw)
+        laps.mark('read')
+        yield fnum, im
+def imread(filename, params=None, raw=False):
     """Load a single image, normalized to the range (0, 1). 
     Attempts to replicate matplotlib.imread() without matplotlib.
     Uses "maxgray" in 'params', if available.
+
+    'filename' may also be a frame in a stack file (see the framesources module),
+    or a list of filenames, which are read as the slices of a volume. If 
+    'raw', integer frames from stack files are instead returned as stored, 
+    without copying, for identify_frame_tiled() to normalize.
     """
-    if params is None: params = {}
-    imraw = scipy.misc.imread(filename)
-    mg = float(params.get('maxgray', 0))
-    if not mg: # Guess
-        if imraw.dtype.name == 'uint8':
-            mg = 2**8 - 1
-        elif imraw.dtype.name == 'uint16':
-            mg = 2**16 - 1
-        elif imraw.dtype.name.startswith('float'):
-            mg = 1.0
-        else:
-            raise ValueError("Can't guess max gray value of image. Use parameter 'maxgray'.")
-    return imraw / float(mg)
+    if isinstance(filename, framesources.FrameRef):
+        if raw:
+            im = filename.source[filename.index]
+            if im.dtype.kind in 'ui':
+                return im
+        return filename.read(params)
+    if isinstance(filename, (list, tuple)):
+        return np.array([imread(fn, params) for fn in filename])
+    return framesources.normalize_image(scipy.misc.imread(filename), params)
 
-def merge_groups(feats, merge_cutoff):
+def merge_groups(feats, merge_cutoff, method='clusters', zscale=1.0):
+    """Post-process a DataFrame to merge features within 'merge_cutoff' of each other.
+    
+    With the default 'method', "clusters", any chain of features that are each
+    within 'merge_cutoff' of the next is merged completely into one feature.
+    Its position is the intensity-weighted mean of the members, and its 
+    'intensity' is their sum. Other columns are taken from the member that
+    appears first in 'feats'.
+
+    "legacy" selects merge_groups_legacy(), which was the only method in older
+    versions, and which considers only 'x' and 'y'.
+
+    If 'feats' has a 'z' column, distances are 3D, with z multiplied by 'zscale'.
+    """
+    if method == 'legacy':
+        return merge_groups_legacy(feats, merge_cutoff)
+    elif method != 'clusters':
+        raise ValueError('merge method must be "clusters" or "legacy"')
+    nfeats = len(feats)
+    pos_columns = ['x', 'y', 'z'] if 'z' in feats else ['x', 'y']
+    xy = feats[pos_columns].values.astype(float)
+    scaled = xy
+    if 'z' in feats and zscale != 1:
+        scaled = xy * [1, 1, zscale]
+    pairs = np.array(list(cKDTree(scaled).query_pairs(merge_cutoff)) if nfeats else [])
+    if not len(pairs):
+        return feats.copy()
+    graph = scipy.sparse.coo_matrix(
+            (np.ones(len(pairs), dtype=bool), (pairs[:,0], pairs[:,1])),
+            shape=(nfeats, nfeats))
+    ncomp, labels = connected_components(graph, directed=False)
+    # Representative (first) member of each cluster, in original order
+    labels_unique, firsts = np.unique(labels, return_index=True)
+    order = np.argsort(firsts)
+    firsts, labels_unique = firsts[order], labels_unique[order]
+    # Intensity-weighted positions
+    masses = feats['intensity'].values.astype(float)
+    totmass = np.bincount(labels, weights=masses, minlength=ncomp)
+    weights = masses
+    if np.any(totmass <= 0): # Weighting is meaningless; fall back to plain mean.
+        weights = np.where((totmass <= 0)[labels], 1.0, masses)
+    wsum = np.bincount(labels, weights=weights, minlength=ncomp)
+    feats_merged = feats.iloc[firsts].copy()
+    for i, col in enumerate(pos_columns):
+        feats_merged[col] = (np.bincount(labels, weights=weights * xy[:,i], 
+            minlength=ncomp) / wsum)[labels_unique]
+    feats_merged['intensity'] = totmass[labels_unique]
+    return feats_merged
+def merge_groups_legacy(feats, merge_cutoff):
     """Post-process a DataFrame to merge features within 'merge_cutoff' of each other.
     
     Sums the values in the 'intensity' column, and sets 'rg2' to NaN.
@@ -182,6 +752,8 @@ def merge_groups(feats, merge_cutoff):
     Uses a crude algorithm that merges any close neighbors it encounters. This means
     that extended cluters of multiple features may not be completely merged, if a
     feature at the edge of the cluster is examined first.
+
+    Superseded by merge_groups(), but kept for reproducing old results.
     """
     xy = feats[['x', 'y']].values
     masses = feats[['intensity']].values
@@ -222,17 +794,22 @@ def interpret_window(windowdict):
             xmax=float(windowdict.get('xmax', -1)) - 1,
             ymin=float(windowdict.get('ymin', 1)) - 1, 
             ymax=float(windowdict.get('ymax', -1)) - 1,
+            zmin=float(windowdict.get('zmin', 1)) - 1, 
+            zmax=float(windowdict.get('zmax', -1)) - 1,
             firstframe=int(windowdict.get('firstframe', 1)), 
             lastframe=int(windowdict.get('lastframe', -1)))
     if win['xmax'] < 0:
         win['xmax'] = np.inf
     if win['ymax'] < 0:
         win['ymax'] = np.inf
+    if win['zmax'] < 0:
+        win['zmax'] = np.inf
     return win
 def link_dataframes(points, params):
     """Takes an iterator of (framenumber, DataFrame) tuples. 
 
-    Requires columns 'x', 'y'.
+    Requires columns 'x', 'y'. If the first frame also has a 'z' column,
+    particles are linked in 3D, with z multiplied by the 'zscale' parameter.
     Returns an iterable of DataFrames, now with 'particle' and 'frame' columns.
     
     See module docs for 'params'
@@ -257,113 +834,703 @@ def link_dataframes(points, params):
     else:
         linker = trackpy.linking.link_df_iter
 
+    zscale = float(params.get('zscale', 1))
+
     def prepareFrame(frame, fnum):
         frame = frame.copy()
         frame['frame'] = fnum
+        if 'z' in frame and zscale != 1:
+            frame['_zlink'] = frame['z'] * zscale
         return frame
 
-    return linker((prepareFrame(fr, fn) for fn, fr in points),
+    def link(points):
+        points = iter(points)
+        try:
+            first = next(points)
+        except StopIteration:
+            return
+        points = itertools.chain([first], points)
+        kw = {}
+        if 'z' in first[1]:
+            kw['pos_columns'] = ['x', 'y', 'z' if zscale == 1 else '_zlink']
+        for ftr in linker((prepareFrame(fr, fn) for fn, fr in points),
                                 search_range,
                                 memory=memory,
                                 neighbor_strategy='KDTree',
                                 link_strategy='auto',
-                                retain_index=True)
+                                retain_index=True, **kw):
+            if '_zlink' in ftr:
+                del ftr['_zlink']
+            yield ftr
+    return link(points)
 # An entire tracking pipeline, including storage to disk
 def track2disk(imgfilenames, outfilename, params, selectframes=None, 
-        window=None, progress=False, statusfile=None):
+        window=None, progress=False, statusfile=None, workers=None,
+        pipeline=False, queue_depth=8, storage=None, resume=False, blocksize=None,
+        timing=False, feature_store=None, link_only=False):
     """Implements a complete tracking process, from image files to a complete
     pytables (HDF5) database on disk.
 
     Appropriate for large datasets.
     
-    'imgfilenames' is the complete list of image files.
+    'imgfilenames' is the complete list of image files, or a stack of frames
+        opened with framesources.open_stack(). For 3D tracking, each item may 
+        instead be a list of z slice filenames, or the stack may be of volumes.
+        A 'z' column is then added to the tracks table.
     'outfilename' conventionally has the ".h5" extension.
     See module docs for 'params' and 'window'.
     'selectframes' is a list of frame numbers to use, COUNTING FROM 1. Default is all.
     If 'progress', a status message will be displayed in IPython.
     'statusfile' optionally creates a JSON file that is continually updated with status
-        information.
+        information. If it ends in ".sqlite" or ".db", the status is instead 
+        written to an SQLite database shared by many jobs; see statusboard.StatusDB.
+    'workers' optionally sets the number of processes used for feature identification.
+        Linking and writing to disk are still done in this process, in frame order.
+    If 'pipeline', images are read ahead in a background thread, and tracks are 
+        written to disk in another, so that I/O overlaps with computation. 
+        'queue_depth' frames may wait between stages. With 'workers', images are
+        instead read by the worker processes. The number of frames waiting in each
+        queue is reported in the status file.
+    'blocksize' optionally sets the number of frames to identify together.
+        See feature_iter().
+    'storage' is a dict of options for batching and compressing writes to disk
+        (see module docs). Write throughput and compression are reported in 
+        the status file.
+    If 'timing', the time spent in each stage (reading, each step of identification,
+        linking, and writing) is measured, and rolling statistics are added to
+        the status file, along with the stage that has taken the most time.
+        See statusboard.StageTimes. With 'workers', the stages of identification
+        are timed in the worker processes and reported as such; this process
+        instead reports the time it spends waiting for them ('wait_identify').
+        Likewise, with 'pipeline', reading and writing are timed in their own
+        threads, and the main thread reports its wait for images ('wait_read').
+        With the 'tile_workers' parameter, the stages of each tile are timed 
+        in its thread, and the main thread reports the time for all 'tiles'.
+    'feature_store' optionally names an HDF5 file (or is a FeatureStore) in which 
+        identified features are kept. Frames whose features are already there
+        are not read or identified, so that relinking with different linking 
+        parameters is fast. See the featurestore module. If 'link_only', every 
+        frame must be in the store. 'pipeline' is then ignored, since the store 
+        and the tracks file cannot both be used by PyTables from different 
+        threads.
+    If 'resume' and 'outfilename' exists, continue an interrupted run from its
+        last checkpoint (see 'checkpoint_frames' in the module docs). Rows written
+        after the checkpoint are discarded. To restore the state of the linker,
+        the last few frames before the checkpoint are read back from the file
+        and linked again, so that particle IDs continue as they would have in 
+        an uninterrupted run. The same arguments must be used as in the
+        original run.
 
     NOTE: track.imread() is used to read the image files. This does not always behave
     as the more familiar imread() in pylab.
     """
+    from . import pipeline as pipeline_mod
+    resuming = resume and os.path.exists(outfilename)
+    if os.path.exists(outfilename) and not resuming: # Check now *and* later
+        raise IOError('Output file already exists.')
+    imgfilenames = framesources.frame_list(imgfilenames)
+    filepairs_all = [(i + 1, filename) for i, filename in enumerate(imgfilenames)]
+    if selectframes is None:
+        filepairs = filepairs_all
+    else:
+        filepairs = [filepairs_all[i - 1] for i in selectframes]
+    use_pool = workers is not None and int(workers) > 1
+    tracks = _TracksWriter(outfilename, len(imgfilenames), storage=storage)
+    reader = writer = store = None
+    times = StageTimes() if timing else None
+    enable_stage_timing(times)
+    laps = stage_laps()
     try: # Always close output file
-        outfile = None
-        if os.path.exists(outfilename): # Check now *and* later
-            raise IOError('Output file already exists.')
-        filepairs_all = [(i + 1, filename) for i, filename in enumerate(imgfilenames)]
-        if selectframes is None:
-            filepairs = filepairs_all
-        else:
-            filepairs = [filepairs_all[i - 1] for i in selectframes]
+        replay = []
+        if resuming:
+            ckpt = tracks.reopen()
+            nframes_done = ckpt['nframes']
+            if nframes_done > len(filepairs) or (nframes_done and 
+                    filepairs[nframes_done - 1][0] != ckpt['frame']):
+                raise ValueError('Checkpoint does not match the frames to be tracked.')
+            # Replay enough frames to cover the linker's memory, twice over.
+            nreplay = 2 * (int(params.get('memory', 0)) + 1)
+            replay = tracks.read_frames(
+                    [fn for fn, filename in filepairs[:nframes_done]][-nreplay:])
+            filepairs = filepairs[nframes_done:]
         if statusfile is not None:
             stopwatch = Stopwatch()
-            statfile = StatusFile(statusfile, 
+            statfile = open_status(statusfile, 
                     dict(totalframes=len(filepairs), outfile=outfilename,
                         working_dir=os.getcwd(), process_id=os.getpid(),
                         started=stopwatch.started))
             statfile.update(dict(status='starting'))
-        tracks_iter = link_dataframes(feature_iter(filepairs, params, window=window), 
-                params)
+        if feature_store is not None or link_only:
+            from .featurestore import FeatureStore
+            if link_only and feature_store is None:
+                raise ValueError('"link_only" requires a feature store.')
+            store = feature_store
+            if not isinstance(store, FeatureStore):
+                store = FeatureStore(feature_store, params, window=window)
+            features = stored_feature_iter(filepairs, store, params, window=window,
+                    link_only=link_only, workers=workers, blocksize=blocksize)
+        elif pipeline and not use_pool:
+            plan = IdentificationPlan(params, window)
+            reader = pipeline_mod.Prefetcher(image_iter(filepairs, plan.params,
+                raw=plan.raw_frames, concurrent=True), queue_depth)
+            features = (item for block in 
+                    _blocks(_timed_waits(reader, 'wait_read'), int(blocksize or 1))
+                    for item in _identify_images(block, plan))
+        else:
+            features = feature_iter(filepairs, params, window=window, workers=workers,
+                    blocksize=blocksize)
+        if pipeline and store is None: # PyTables is not thread-safe.
+            def append(fnum, ftr):
+                mark_concurrent_thread()
+                tracks.append(fnum, ftr)
+            writer = pipeline_mod.BackgroundWriter(append, queue_depth)
+        if replay:
+            tracks_iter = _relabel_resumed(
+                    link_dataframes(itertools.chain(replay, features), params),
+                    len(replay), ckpt['next_particle'])
+        else:
+            tracks_iter = link_dataframes(features, params)
+        laps.start()
         for loopcount, ((fnum, filename), ftr) in enumerate(itertools.izip(filepairs, tracks_iter)):
+            laps.mark('link')
+            if writer is not None:
+                writer.put(fnum, ftr)
+            else:
+                tracks.append(fnum, ftr)
             if statusfile is not None:
                 stopwatch.lap()
-                statfile.update(dict(status='working', mr_frame=fnum, mr_imgfile='filename',
+                status = dict(status='working', mr_frame=fnum, mr_imgfile='filename',
                     nparticles=len(ftr), seconds_per_frame=stopwatch.mean_lap_time(),
                     elapsed_time=format_td(stopwatch.elapsed()), 
-                    time_left=format_td(stopwatch.estimate_completion(len(filepairs)))))
+                    time_left=format_td(stopwatch.estimate_completion(len(filepairs))))
+                if reader is not None:
+                    status['read_queue'] = reader.qsize()
+                if writer is not None:
+                    status['write_queue'] = writer.qsize()
+                status['storage'] = tracks.stats()
+                if times is not None:
+                    status['stages'] = times.summary()
+                    status['dominant_stage'] = times.dominant()
+                statfile.update(status)
             if progress:
                 import IPython.display
                 IPython.display.clear_output()
                 print '{} particles in frame {} ({} of {}): {}'.format(
                         len(ftr), fnum, loopcount+1, len(filepairs), filename)
                 sys.stdout.flush()
-            if outfile is None:
-                # We create the output file now so we can provide an estimate of total size.
-                if os.path.exists(outfilename):
-                    raise IOError('Output file already exists.')
-                outfile = tables.openFile(outfilename, 'w')
-                alltracks = outfile.createTable('/', 'bigtracks', TrackPoint,
-                        expectedrows=len(ftr) * len(imgfilenames),)
-                        #filters=tables.Filters(complevel=5, complib='blosc'))
-            alltracks.append(
-                ftr[['frame', 'particle', 
-                        'x', 'y', 'intensity', 'rg2']].values.astype('float32'))
-            alltracks.flush()
+            laps.start()
+        if writer is not None:
+            writer.close()
         if statusfile is not None:
             statfile.update(dict(status='finishing',
                 elapsed_time=format_td(stopwatch.elapsed()),
                 seconds_per_frame=stopwatch.mean_lap_time()))
-        if outfile is not None:
-            _create_table_indices(alltracks)
+        tracks.finish()
+        if statusfile is not None:
+            storage_stats = tracks.stats()
     finally:
-        if outfile is not None:
-            outfile.close()
+        if reader is not None:
+            reader.stop()
+        if writer is not None:
+            writer.join() # Don't close the file out from under the writer thread
+        tracks.close()
+        enable_stage_timing(None)
+        if store is not None and store is not feature_store:
+            store.close()
     if statusfile is not None:
-        statfile.update(dict(status='done',
+        done = dict(status='done',
             elapsed_time=format_td(stopwatch.elapsed()),
-            seconds_per_frame=stopwatch.mean_lap_time()))
+            seconds_per_frame=stopwatch.mean_lap_time(),
+            storage=storage_stats)
+        if times is not None:
+            done.update(stages=times.summary(), dominant_stage=times.dominant())
+        statfile.update(done)
+
+def track2disk_chunked(imgfilenames, outfilename, params, selectframes=None,
+        window=None, chunks=4, overlap=None, workers=None, statusfile=None, 
+        storage=None, progress=False, heartbeat=60.):
+    """Like track2disk(), but splits the movie into 'chunks' ranges of frames 
+    that are tracked in parallel, in 'workers' processes (default: 'chunks').
+
+    Each chunk after the first also tracks the last 'overlap' frames of the 
+    chunk before it. The chunks are then stitched together in order: in the 
+    overlap, a feature found by both chunks takes its particle ID from the 
+    earlier chunk, and particles that are new in the later chunk are numbered 
+    after all those in the earlier one. By the end of the overlap, the later 
+    chunk has seen as much history as the linker remembers, so the result is
+    the same as for track2disk(), as long as 'overlap' exceeds 'memory' (default
+    is 2 * ('memory' + 1), as when resuming). Predictors that use a longer 
+    history may need a larger 'overlap'. A custom 'predictor' in 'params' is 
+    copied to each worker process, so it must be picklable; each chunk starts
+    with a fresh copy.
+
+    Chunks are tracked into temporary files in the directory 'outfilename' + 
+    ".chunks", which is deleted when the stitched file is complete. 'statusfile'
+    reports the number of chunks stitched. While waiting for a chunk, it is 
+    also updated every 'heartbeat' seconds, so that the job is not reported 
+    as dead.
+    """
+    import multiprocessing, shutil, cPickle
+    if os.path.exists(outfilename):
+        raise IOError('Output file already exists.')
+    if params.get('predictor') is not None:
+        try:
+            cPickle.dumps(params['predictor'], cPickle.HIGHEST_PROTOCOL)
+        except Exception as err:
+            raise ValueError('The "predictor" must be picklable to track in chunks: %s'
+                    % err)
+    if selectframes is None:
+        selectframes = range(1, len(framesources.frame_list(imgfilenames)) + 1)
+    selectframes = list(selectframes)
+    if overlap is None:
+        overlap = 2 * (int(params.get('memory', 0)) + 1)
+    # Each chunk must be longer than the overlap.
+    chunks = max(min(int(chunks), len(selectframes) // (overlap + 1)), 1)
+    bounds = np.linspace(0, len(selectframes), chunks + 1).astype(int)
+    chunkdir = outfilename + '.chunks'
+    if not os.path.exists(chunkdir):
+        os.mkdir(chunkdir)
+    chunkstorage = dict(storage or {}, sort_by_particle=0)
+    jobs = [(imgfilenames, os.path.join(chunkdir, 'chunk_%.4i.h5' % i), params, 
+        selectframes[max(bounds[i] - overlap, 0) if i else 0:bounds[i + 1]],
+        window, chunkstorage) for i in range(chunks)]
+    for job in jobs:
+        if os.path.exists(job[1]):
+            os.remove(job[1]) # Left over from an earlier attempt
+    if statusfile is not None:
+        stopwatch = Stopwatch()
+        statfile = open_status(statusfile, dict(totalframes=len(selectframes), 
+            outfile=outfilename, working_dir=os.getcwd(), process_id=os.getpid(),
+            started=stopwatch.started, chunks=chunks))
+        statfile.update(dict(status='working', chunks_done=0))
+    tracks = _TracksWriter(outfilename, len(selectframes), storage=storage)
+    pool = multiprocessing.Pool(int(workers or chunks))
+    openfiles = []
+    try:
+        prevtable = previdmap = None
+        next_particle = 0
+        chunkfiles = pool.imap(_track_chunk, jobs)
+        for i in range(chunks):
+            while True:
+                try:
+                    chunkfile = chunkfiles.next(float(heartbeat))
+                    break
+                except multiprocessing.TimeoutError:
+                    if statusfile is not None:
+                        statfile.update(dict(status='working', chunks_done=i,
+                            elapsed_time=format_td(stopwatch.elapsed())))
+            chunkframes = jobs[i][3]
+            nover = overlap if i else 0
+            openfiles.append(tables.openFile(chunkfile, 'r'))
+            table = openfiles[-1].root.bigtracks
+            if prevtable is None:
+                idmap = {}
+            else:
+                idmap = _chunk_overlap_map(prevtable, previdmap, table, 
+                        chunkframes[:nover])
+                openfiles.pop(0).close()
+            for fnum, ftr in _read_chunk_frames(table, chunkframes[nover:]):
+                for local in sorted(set(ftr['particle'].values).difference(idmap)):
+                    idmap[local] = next_particle
+                    next_particle += 1
+                ftr['particle'] = ftr['particle'].map(idmap)
+                tracks.append(fnum, ftr)
+            prevtable, previdmap = table, idmap
+            if statusfile is not None:
+                statfile.update(dict(status='working', chunks_done=i + 1,
+                    elapsed_time=format_td(stopwatch.elapsed()), 
+                    storage=tracks.stats()))
+            if progress:
+                print 'Stitched chunk {} of {}'.format(i + 1, chunks)
+                sys.stdout.flush()
+        pool.close()
+        tracks.finish()
+        storage_stats = tracks.stats()
+    finally:
+        pool.terminate()
+        pool.join()
+        for h5 in openfiles:
+            h5.close()
+        tracks.close()
+    shutil.rmtree(chunkdir)
+    if statusfile is not None:
+        statfile.update(dict(status='done', chunks_done=chunks,
+            elapsed_time=format_td(stopwatch.elapsed()), storage=storage_stats))
+def _track_chunk(job):
+    """Track one chunk for track2disk_chunked(), in a worker process."""
+    imgfilenames, chunkfile, params, selectframes, window, storage = job
+    track2disk(imgfilenames, chunkfile, params, selectframes=selectframes, 
+            window=window, storage=storage)
+    return chunkfile
+def _read_chunk_frames(table, framenumbers, blockframes=1000):
+    """Yield (frame number, DataFrame) for each of 'framenumbers' in a tracks 
+    table, reading 'blockframes' at a time."""
+    for block in _blocks(framenumbers, blockframes):
+        rows = pandas.DataFrame(table.readWhere('(frame >= lo) & (frame <= hi)',
+            condvars=dict(lo=min(block), hi=max(block))))
+        byframe = dict(iter(rows.groupby('frame')))
+        for fn in block:
+            yield fn, byframe[fn].reset_index(drop=True) if fn in byframe \
+                    else rows[:0].copy()
+def _chunk_overlap_map(prevtable, previdmap, table, framenumbers):
+    """Map particle IDs in 'table' to the global IDs of the same features in
+    'prevtable' (translated by 'previdmap'), in overlap frames 'framenumbers'.
+    
+    Features are matched by frame and position, which are identical because
+    both chunks identified the same images. Later frames take precedence."""
+    idmap = {}
+    if not len(framenumbers):
+        return idmap
+    cond, condvars = '(frame >= lo) & (frame <= hi)', \
+            dict(lo=min(framenumbers), hi=max(framenumbers))
+    prev = pandas.DataFrame(prevtable.readWhere(cond, condvars=condvars))
+    cur = pandas.DataFrame(table.readWhere(cond, condvars=condvars))
+    matched = pandas.merge(cur, prev, on=['frame', 'x', 'y'], 
+            suffixes=('', '_prev')).sort('frame')
+    idmap.update(itertools.izip(matched['particle'].values, 
+        matched['particle_prev'].map(previdmap).values))
+    return idmap
+def _relabel_resumed(tracks_iter, nreplay, next_particle):
+    """Translate particle IDs from a linker restarted by track2disk(resume=True).
+
+    The first 'nreplay' frames from 'tracks_iter' are the replayed frames, which have
+    their original IDs in the '_stored_particle' column; they are consumed but not
+    yielded. New particles after that are numbered from 'next_particle'.
+    """
+    idmap = {}
+    for i, ftr in enumerate(tracks_iter):
+        if i < nreplay:
+            # Later frames overwrite earlier ones, so each ID maps to its most
+            # recent appearance.
+            idmap.update(itertools.izip(ftr['particle'].values, 
+                ftr['_stored_particle'].values))
+            continue
+        for fresh in sorted(set(ftr['particle'].values).difference(idmap)):
+            idmap[fresh] = next_particle
+            next_particle += 1
+        ftr = ftr.copy()
+        ftr['particle'] = ftr['particle'].map(idmap)
+        if '_stored_particle' in ftr:
+            del ftr['_stored_particle']
+        yield ftr
+class _TracksWriter(object):
+    """Appends linked features to the 'bigtracks' table of a new HDF5 file.
+
+    The file is created when the first frame arrives, so that its size can be
+    estimated from 'totalframes'. Frames are collected in memory and appended
+    together, according to the 'storage' options (see module docs).
+
+    Checkpoints are stored as attributes of the table. Each one records a number
+    of frames and table rows that are known to be complete, and the next unused
+    particle ID.
+    """
+    def __init__(self, outfilename, totalframes, storage=None):
+        if storage is None: storage = {}
+        self.outfilename = outfilename
+        self.totalframes = totalframes
+        self.flush_frames = max(int(storage.get('flush_frames', 1)), 1)
+        self.flush_bytes = float(storage.get('flush_mb', 0)) * 2**20
+        self.checkpoint_frames = int(storage.get('checkpoint_frames', 100))
+        complevel = int(storage.get('complevel', 0))
+        if complevel:
+            self.filters = tables.Filters(complevel=complevel,
+                    complib=storage.get('complib', 'blosc'),
+                    shuffle=bool(int(storage.get('shuffle', 1))))
+        else:
+            self.filters = None
+        self.chunkrows = int(storage.get('chunkrows', 0))
+        self.index_kind = storage.get('index_kind', 'medium')
+        self.index_optlevel = int(storage.get('index_optlevel', 6))
+        self.sort_by_particle = bool(int(storage.get('sort_by_particle', 0)))
+        self.storage = storage
+        self.outfile = None
+        self.table = None
+        self.columns = None
+        self.dtype = None
+        # Pending rows are collected in one reusable buffer, which grows as needed.
+        self._buffer = None
+        self._pending_frames = 0
+        self._pending_rows = 0
+        # Progress, for checkpoints
+        self.nframes = 0 # Frames written
+        self.last_frame = None
+        self.next_particle = 0
+        self._checkpointed_nframes = 0
+        # Statistics
+        self.nrows = 0
+        self.nflushes = 0
+        self.write_seconds = 0.
+        self.file_bytes = 0
+    def _create(self, ftr):
+        """Create the file, with a 'z' column if 'ftr' has one."""
+        if os.path.exists(self.outfilename):
+            raise IOError('Output file already exists.')
+        self.outfile = tables.openFile(self.outfilename, 'w')
+        kw = {}
+        if self.filters is not None:
+            kw['filters'] = self.filters
+        if self.chunkrows:
+            kw['chunkshape'] = (self.chunkrows,)
+        self.dtype = tracks_dtype(self.storage, threed='z' in ftr)
+        self.columns = list(self.dtype.names)
+        self.table = self.outfile.createTable('/', 'bigtracks', self.dtype,
+                expectedrows=len(ftr) * self.totalframes, **kw)
+        self.table.attrs.schema = json.dumps(
+                [(name, self.dtype[name].name) for name in self.columns])
+        self.checkpoint()
+    def reopen(self):
+        """Open an existing file and roll it back to its last checkpoint.
+
+        Returns dict with the number of frames ('nframes') and last frame number
+        ('frame') completed, and 'next_particle'.
+        """
+        self.outfile = tables.openFile(self.outfilename, 'a')
+        self.table = self.outfile.root.bigtracks
+        self.columns = list(self.table.colnames)
+        self.dtype = self.table.dtype
+        attrs = self.table.attrs
+        if 'checkpoint_nframes' not in attrs:
+            raise IOError('No checkpoint in "%s"; cannot resume.' % self.outfilename)
+        for col in (self.table.cols.frame, self.table.cols.particle):
+            if col.index is not None:
+                col.removeIndex()
+        for name in ('bytracks', 'particles'):
+            if name in self.outfile.root:
+                self.outfile.removeNode('/', name)
+        self.table.truncate(int(attrs.checkpoint_nrows))
+        self.outfile.flush()
+        self.nrows = self.table.nrows
+        self.nframes = self._checkpointed_nframes = int(attrs.checkpoint_nframes)
+        self.last_frame = attrs.checkpoint_frame
+        self.next_particle = int(attrs.checkpoint_next_particle)
+        return dict(nframes=self.nframes, frame=self.last_frame,
+                next_particle=self.next_particle)
+    def read_frames(self, framenumbers):
+        """Read back the features in 'framenumbers' as a list of 
+        (frame number, DataFrame), suitable for link_dataframes().
+        
+        The original particle IDs are in the '_stored_particle' column."""
+        if not len(framenumbers):
+            return []
+        rows = pandas.DataFrame(self.table.readWhere('(frame >= lo) & (frame <= hi)',
+            condvars=dict(lo=min(framenumbers), hi=max(framenumbers))))
+        rows = rows.astype(float).rename(columns={'particle': '_stored_particle'})
+        return [(fn, rows[rows.frame == fn].drop('frame', axis=1).reset_index(drop=True))
+                for fn in framenumbers]
+    def append(self, fnum, ftr):
+        """Write the DataFrame 'ftr', which has 'frame' and 'particle' columns."""
+        if self.outfile is None:
+            self._create(ftr)
+        start, stop = self._pending_rows, self._pending_rows + len(ftr)
+        if self._buffer is None or stop > len(self._buffer):
+            self._grow_buffer(stop)
+        rows = self._buffer[start:stop]
+        for name in self.columns: # Cast and copy each column in one pass
+            rows[name] = ftr[name].values
+        self._pending_rows = stop
+        self._pending_frames += 1
+        self.last_frame = fnum
+        if len(ftr):
+            self.next_particle = max(self.next_particle, int(ftr['particle'].max()) + 1)
+        if self._pending_frames >= self.flush_frames or (self.flush_bytes and 
+                self._pending_rows * self.dtype.itemsize >= self.flush_bytes):
+            self.flush()
+    def _grow_buffer(self, nrows):
+        """Make room for at least 'nrows' pending rows, keeping those already there."""
+        size = max(nrows, 2 * len(self._buffer) if self._buffer is not None else 1024)
+        buf = np.empty(size, dtype=self.dtype)
+        if self._pending_rows:
+            buf[:self._pending_rows] = self._buffer[:self._pending_rows]
+        self._buffer = buf
+    def flush(self):
+        """Write all pending frames to disk, and checkpoint if it's time."""
+        if not self._pending_frames:
+            return
+        laps = stage_laps()
+        laps.start()
+        t0 = time.time()
+        rows = self._buffer[:self._pending_rows]
+        if len(rows):
+            self.table.append(rows) # Copied, so the buffer can be reused
+        self.table.flush()
+        self.nframes += self._pending_frames
+        if self.checkpoint_frames and \
+                self.nframes - self._checkpointed_nframes >= self.checkpoint_frames:
+            self.checkpoint()
+        self.write_seconds += time.time() - t0
+        self.nrows += len(rows)
+        self.nflushes += 1
+        self._pending_frames = 0
+        self._pending_rows = 0
+        self.file_bytes = os.path.getsize(self.outfilename)
+        laps.mark('write')
+    def checkpoint(self):
+        """Record the data already flushed to disk as complete."""
+        attrs = self.table.attrs
+        attrs.checkpoint_nframes = self.nframes
+        attrs.checkpoint_nrows = self.table.nrows
+        attrs.checkpoint_frame = self.last_frame if self.nframes else -1
+        attrs.checkpoint_next_particle = self.next_particle
+        self.outfile.flush()
+        self._checkpointed_nframes = self.nframes
+    def stats(self):
+        """Dict of write throughput and compression, for the status file."""
+        if self.table is None:
+            return {}
+        data_mb = self.nrows * self.table.rowsize / 2.**20
+        file_mb = self.file_bytes / 2.**20
+        return dict(rows_written=self.nrows, flushes=self.nflushes,
+                data_mb=round(data_mb, 3), file_mb=round(file_mb, 3),
+                compression_ratio=round(data_mb / file_mb, 3) if file_mb else None,
+                write_seconds=round(self.write_seconds, 3),
+                write_mb_per_sec=round(data_mb / self.write_seconds, 3) \
+                        if self.write_seconds else None)
+    def finish(self):
+        """Write any pending frames and index the completed table."""
+        if self.table is not None:
+            self.flush()
+            self.checkpoint()
+            _create_table_indices(self.table, self.index_optlevel, self.index_kind,
+                    csi_particle=self.sort_by_particle)
+            if self.sort_by_particle:
+                _create_particle_sorted(self.table, filters=self.filters)
+    def close(self):
+        if self.outfile is not None:
+            self.outfile.close()
 
 # Tracks file indexing
-def create_tracksfile_indices(tracksfilename):
+def create_tracksfile_indices(tracksfilename, storage=None):
     """Create indices for the tracks data in the HDF5 file 'tracksfilename'.
     Indices are necessary to efficiently access the data.
 
     This is only necessary if the normal tracking process (with track2disk())
-    did not finish successfully.
+    did not finish successfully, or to add a particle-sorted copy afterward.
+    'storage' is as for track2disk(); only the index options and 
+    'sort_by_particle' are used.
     """
+    if storage is None: storage = {}
+    sort_by_particle = bool(int(storage.get('sort_by_particle', 0)))
     outfile = tables.openFile(tracksfilename, 'a')
     try:
         trtab = outfile.root.bigtracks
-        _create_table_indices(trtab)
+        for col in (trtab.cols.frame, trtab.cols.particle):
+            if col.index is not None:
+                col.removeIndex()
+        _create_table_indices(trtab, int(storage.get('index_optlevel', 6)),
+                storage.get('index_kind', 'medium'), csi_particle=sort_by_particle)
+        if sort_by_particle:
+            for name in ('bytracks', 'particles'):
+                if name in outfile.root:
+                    outfile.removeNode('/', name)
+            _create_particle_sorted(trtab, filters=trtab.filters)
     finally:
         outfile.close()
-def _create_table_indices(trackstable):
-    """Create indices on the tracks PyTables table."""
-    trackstable.cols.frame.createIndex()
-    trackstable.cols.particle.createIndex()
+def _create_table_indices(trackstable, optlevel=6, kind='medium', csi_particle=False):
+    """Create indices on the tracks PyTables table.
+    If 'csi_particle', the index on 'particle' is completely sorted."""
+    trackstable.cols.frame.createIndex(optlevel=optlevel, kind=kind)
+    if csi_particle:
+        trackstable.cols.particle.createCSIndex()
+    else:
+        trackstable.cols.particle.createIndex(optlevel=optlevel, kind=kind)
+def _create_particle_sorted(trackstable, filters=None, blockrows=2**20):
+    """Write 'bytracks', a copy of 'trackstable' sorted by particle, and the
+    'particles' lookup table, next to it. 'trackstable' must have a completely
+    sorted index on 'particle'.
+
+    The lookup table is built from 'blockrows' rows at a time.
+    """
+    h5 = trackstable._v_file
+    kw = {}
+    if filters is not None:
+        kw['filters'] = filters
+    sortedtab = trackstable.copy('/', 'bytracks', sortby='particle', 
+            checkCSI=True, propindexes=False, **kw)
+    if 'checkpoint_next_particle' in trackstable.attrs:
+        nparticles = int(trackstable.attrs.checkpoint_next_particle)
+    elif sortedtab.nrows: # Older file; IDs are numbered from 0
+        nparticles = int(sortedtab.cols.particle[-1]) + 1
+    else:
+        nparticles = 1
+    lookup = h5.createTable('/', 'particles', ParticleRange, 
+            expectedrows=max(nparticles, 1), **kw)
+    current = None # [particle, start, length] of the run in progress
+    for start in xrange(0, sortedtab.nrows, blockrows):
+        ids = sortedtab.cols.particle[start:start + blockrows]
+        # Rows where a new particle begins
+        breaks = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+        runstarts = np.concatenate([[0], breaks])
+        runlengths = np.diff(np.concatenate([runstarts, [len(ids)]]))
+        rows = []
+        for runstart, runlength in itertools.izip(runstarts, runlengths):
+            if current is not None and runstart == 0 and ids[0] == current[0]:
+                current[2] += runlength # Continued from the last block
+                continue
+            if current is not None:
+                rows.append(tuple(current))
+            current = [ids[runstart], start + runstart, runlength]
+        if rows:
+            lookup.append(rows)
+    if current is not None:
+        lookup.append([tuple(current)])
+    lookup.flush()
+    lookup.cols.particle.createIndex()
+    h5.flush()
+def read_trajectory(tracksfile, particle):
+    """DataFrame of one particle's trajectory, in frame order, from a tracks
+    file (an open PyTables File) written with the 'sort_by_particle' storage 
+    option. Only one contiguous slice of the 'bytracks' table is read.
+
+    Returns None if there is no such particle.
+    """
+    found = tracksfile.root.particles.readWhere('particle == p', 
+            condvars=dict(p=int(particle)))
+    if not len(found):
+        return None
+    start, length = int(found['start'][0]), int(found['length'][0])
+    rows = pandas.DataFrame(tracksfile.root.bytracks.read(start, start + length))
+    return rows.sort('frame').reset_index(drop=True)
 
 # Format of the tracks data file
+TRACKS_OPTIONAL_COLUMNS = ['intensity', 'rg2']
+def tracks_dtype(storage=None, threed=False):
+    """numpy dtype of rows in the tracks table, according to the 'storage' 
+    options (see module docs). The default is equivalent to TrackPoint 
+    (or TrackPoint3D if 'threed')."""
+    if storage is None: storage = {}
+    def coltype(option, allowed):
+        dt = np.dtype(storage.get(option, 'float32'))
+        if dt.name not in allowed:
+            raise ValueError('"%s" must be one of %s' % (option, ', '.join(allowed)))
+        return dt
+    frametype = coltype('frame_dtype', ('float32', 'int32', 'int64'))
+    particletype = coltype('particle_dtype', ('float32', 'int32', 'int64'))
+    floattype = coltype('float_dtype', ('float32', 'float64'))
+    drop = storage.get('drop_columns', [])
+    if isinstance(drop, basestring):
+        drop = [c.strip() for c in drop.split(',') if c.strip()]
+    for col in drop:
+        if col not in TRACKS_OPTIONAL_COLUMNS:
+            raise ValueError('Cannot drop column "%s"' % col)
+    columns = TRACKPOINT3D_COLUMNS if threed else TRACKPOINT_COLUMNS
+    types = dict(frame=frametype, particle=particletype)
+    return np.dtype([(name, types.get(name, floattype)) for name in columns 
+        if name not in drop])
+def tracks_schema(trackstable):
+    """List of (column name, numpy type name) for a tracks PyTables table.
+
+    For files written before the schema was recorded, the types are read from 
+    the table itself."""
+    if 'schema' in trackstable.attrs:
+        return [tuple(c) for c in json.loads(trackstable.attrs.schema)]
+    return [(name, trackstable.coldtypes[name].name) for name in trackstable.colnames]
+TRACKPOINT_COLUMNS = ['frame', 'particle', 'x', 'y', 'intensity', 'rg2']
+TRACKPOINT3D_COLUMNS = ['frame', 'particle', 'x', 'y', 'z', 'intensity', 'rg2']
+class ParticleRange(tables.IsDescription):
+    """pytables format for the lookup table of a particle-sorted tracks table"""
+    particle = tables.Int64Col(pos=1)
+    start = tables.Int64Col(pos=2)
+    length = tables.Int64Col(pos=3)
 class TrackPoint(tables.IsDescription):
     """pytables format for tracks data"""
     frame = tables.Float32Col(pos=1)
@@ -372,4 +1539,12 @@ class TrackPoint(tables.IsDescription):
     y = tables.Float32Col(pos=4)
     intensity = tables.Float32Col(pos=5)
     rg2 = tables.Float32Col(pos=6)
-
+class TrackPoint3D(tables.IsDescription):
+    """pytables format for tracks data with a z coordinate"""
+    frame = tables.Float32Col(pos=1)
+    particle = tables.Float32Col(pos=2)
+    x = tables.Float32Col(pos=3)
+    y = tables.Float32Col(pos=4)
+    z = tables.Float32Col(pos=5)
+    intensity = tables.Float32Col(pos=6)
+    rg2 = tables.Float32Col(pos=7)